@@ -1,18 +1,51 @@
+import functools
+import json
+import logging
 import os
 import random
+import time
 
 import torch
 import yaml
-from flask import Flask, jsonify, request, send_from_directory
+from flask import (
+    Flask,
+    Response,
+    jsonify,
+    request,
+    send_from_directory,
+    stream_with_context,
+)
 from flask_cors import CORS
-from src.attention import get_attention_matrices
+from src.attention import (
+    PromptState,
+    get_attention_matrices_incremental,
+    reusable_prefix_length,
+)
 from src.functional import detensorize_objects
+from src.hooking.attention import stream_attention_matrices
 from src.models import ModelandTokenizer
+from src.registry import ModelRegistry, RegisteredModel
+from src.scheduler import AttentionScheduler, SchedulerClosed
+from src.serving import AdmissionController, Overloaded, serve_asgi, serve_prefork
+from src.store import AttentionCache, ResultStore
+from src.utils import logging_utils
+from src.utils.disk_store import DiskStore
+from src.utils.metrics import (
+    METRICS,
+    PROMETHEUS_MIMETYPE,
+    STAGE_SECONDS,
+    Counter,
+    Gauge,
+    Histogram,
+)
+from src.utils.serialization import BINARY_MIMETYPE, binarize_objects, encode_binary
+from src.utils.shared_weights import export_shared_weights, load_shared_model
 
 ###################### INITIALIZATION ######################
 app = Flask(__name__)
 CORS(app)
-MODEL_LOCKED = False
+logging_utils.configure()
+logger = logging.getLogger(__name__)
 
 # Opens path to current file where the config is found, loads connfig
 PATH = os.path.dirname(os.path.abspath(__file__))
@@ -23,9 +56,112 @@ with open(os.path.join(PATH, "../config.yml"), "r") as f:
 URL = config["APP"]["backend_url"]
 BACKEND_PORT = config["APP"]["backend_port"]
 
-MODEL_NAME = config["model"]
+MODEL_NAME = config["model"]  # the default model, loaded at startup
 
-MT = ModelandTokenizer(model_path=MODEL_NAME, torch_dtype=torch.float32)
+# models that can be requested with `/attnmatrix?model=...`, loaded on first use and
+# evicted least recently used first when they would exceed the memory budget
+MODELS = config.get("models", [MODEL_NAME])
+if MODEL_NAME not in MODELS:
+    MODELS = [MODEL_NAME, *MODELS]
+MODEL_MEMORY_BUDGET_MB = config["APP"].get("model_memory_budget_mb", float("inf"))
+
+# with more than one worker, the weights are exported once to this file and every
+# worker process memory-maps it instead of holding its own copy
+N_WORKERS = config["APP"].get("workers", 1)
+SHARED_WEIGHTS = config["APP"].get("shared_weights")
+# one list of core ids per worker, by default the cores are split evenly
+WORKER_CORES = config["APP"].get("worker_cores")
+
+# prompt lengths run through every model right after loading it
+WARMUP_LENGTHS = config["APP"].get("warmup_lengths", [16, 128])
+
+# repeated prompts are served from memory, bounded by the bytes of the stored arrays.
+# with a `result_dir`, results are also kept on disk, shared by the workers and
+# across restarts
+RESULT_DIR = config["APP"].get("result_dir")
+ATTENTION_CACHE = AttentionCache(
+    max_bytes=int(config["APP"].get("attention_cache_mb", 1024) * 2**20),
+    disk=(
+        DiskStore(
+            RESULT_DIR,
+            max_bytes=int(config["APP"].get("result_dir_mb", 10240) * 2**20),
+        )
+        if RESULT_DIR is not None
+        else None
+    ),
+)
+
+# results of `/attnmatrix?lazy=true`, served slice by slice
+RESULT_STORE = ResultStore(
+    max_bytes=int(config["APP"].get("stored_results_mb", 1024) * 2**20)
+)
+
+# the last prompt (and its kv cache) of each `/attnmatrix?session=...`
+SESSIONS = ResultStore(max_bytes=int(config["APP"].get("sessions_mb", 1024) * 2**20))
+
+# requests past this many in flight (running or waiting for the model) get a 503
+ADMISSION = AdmissionController(
+    max_in_flight=config["APP"].get("max_in_flight", 16),
+    retry_after=config["APP"].get("retry_after_s", 1),
+)
+
+# threads of the uvicorn front end on top of `max_in_flight`
+ASGI_SPARE_THREADS = 4
+
+REGISTRY: ModelRegistry = None
+
+
+def load_model(name: str) -> ModelandTokenizer:
+    if name == MODEL_NAME and SHARED_WEIGHTS and os.path.exists(SHARED_WEIGHTS):
+        mt = load_shared_model(name, SHARED_WEIGHTS)
+    else:
+        mt = ModelandTokenizer(model_path=name, torch_dtype=torch.float32)
+    mt.warmup(prompt_lengths=WARMUP_LENGTHS)
+    return mt
+
+
+def make_scheduler(mt: ModelandTokenizer) -> AttentionScheduler:
+    # concurrent /attnmatrix requests are queued and run through the model in batches
+    return AttentionScheduler(
+        mt=mt,
+        max_batch_size=config["APP"].get("max_batch_size", 8),
+        max_wait_ms=config["APP"].get("batch_wait_ms", 5),
+        cache=ATTENTION_CACHE,
+    )
+
+
+def init_worker() -> None:
+    """Sets up the models and loads the default one. Runs once per worker process."""
+    global REGISTRY
+    REGISTRY = ModelRegistry(
+        load_model=load_model,
+        make_scheduler=make_scheduler,
+        budget_mb=MODEL_MEMORY_BUDGET_MB,
+        allowed=MODELS,
+    )
+    REGISTRY.get(MODEL_NAME)
+
+
+def prepare_shared_weights() -> None:
+    """Exports the weights for the workers, in a child process so that the main
+    process never holds them."""
+    if os.path.exists(SHARED_WEIGHTS):
+        return
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            mt = ModelandTokenizer(model_path=MODEL_NAME, torch_dtype=torch.float32)
+            export_shared_weights(mt.model, SHARED_WEIGHTS, model_name=MODEL_NAME)
+            code = 0
+        finally:
+            os._exit(code)
+    _, status = os.waitpid(pid, 0)
+    assert status == 0, f"exporting the weights to {SHARED_WEIGHTS} failed"
+
+
+if N_WORKERS == 1:
+    init_worker()
 
 ###############################################################
 
@@ -47,38 +183,450 @@ def hello():
     return str(random.randint(0, 100))
 
 
-def pool_for_attention_info(prompt):
-    global MODEL_LOCKED
-    while True:
-        if MODEL_LOCKED == True:
-            print(f"prompt={prompt[:min(len(prompt), 80)]}... is waiting for model")
-            continue
-        else:
-            MODEL_LOCKED = True
-            print(f"Processing request: {prompt[:min(len(prompt), 80)]}")
-            attention_information = get_attention_matrices(
-                prompt=prompt,
-                mt=MT,
-            )
-            MODEL_LOCKED = False
+@app.errorhandler(Overloaded)
+def overloaded(error: Overloaded):
+    REQUESTS_REJECTED.inc()
+    response = jsonify({"error": str(error)})
+    response.status_code = 503
+    response.headers["Retry-After"] = str(max(1, round(error.retry_after)))
+    return response
+
+
+def admitted(route):
+    """Rejects the request with a 503 if too many are already in flight."""
+
+    @functools.wraps(route)
+    def wrapper(*args, **kwargs):
+        with ADMISSION.admit():
+            with REQUEST_SECONDS.time(route=request.url_rule.rule):
+                return route(*args, **kwargs)
+
+    return wrapper
+
+
+REQUEST_SECONDS = METRICS.register(
+    Histogram(
+        "http_request_seconds",
+        "Time from admitting a request to returning its response",
+        labelnames=("route",),
+    )
+)
+METRICS.register(
+    Gauge(
+        "attention_queue_depth",
+        "Prompts waiting in each model's scheduler",
+        labelnames=("model",),
+        function=lambda: {
+            (name,): entry.scheduler.queue_depth for name, entry in REGISTRY.items()
+        },
+    )
+)
+METRICS.register(
+    Gauge(
+        "http_requests_in_flight",
+        "Requests running or waiting for the model",
+        function=lambda: ADMISSION.in_flight,
+    )
+)
+REQUESTS_REJECTED = METRICS.register(
+    Counter("http_requests_rejected", "Requests rejected with a 503")
+)
+METRICS.register(
+    Gauge(
+        "attention_cache_hit_rate",
+        "Fraction of attention cache lookups served from memory or disk",
+        function=lambda: ATTENTION_CACHE.stats().hit_rate,
+    )
+)
+METRICS.register(
+    Gauge(
+        "attention_cache_bytes",
+        "Bytes of the results held in the attention cache",
+        function=lambda: ATTENTION_CACHE.stats().nbytes,
+    )
+)
+
+
+@app.route("/metrics")
+def metrics():
+    """Prometheus metrics of this worker."""
+    return Response(METRICS.render(), mimetype=PROMETHEUS_MIMETYPE)
+
+
+@app.route("/stats")
+def stats():
+    cache_stats = ATTENTION_CACHE.stats()
+    return jsonify(
+        {
+            "attention_cache": {
+                **cache_stats.to_dict(),
+                "hit_rate": cache_stats.hit_rate,
+            },
+            "stored_results": len(RESULT_STORE),
+            "stored_results_bytes": RESULT_STORE.nbytes,
+            "sessions": len(SESSIONS),
+            "sessions_bytes": SESSIONS.nbytes,
+            "in_flight": ADMISSION.in_flight,
+            "rejected": ADMISSION.rejected,
+            "models": {
+                name: {
+                    "size_mb": entry.size_mb,
+                    "queue_depth": entry.scheduler.queue_depth,
+                    "load_timings": entry.mt.timings.phases,
+                }
+                for name, entry in REGISTRY.items()
+            },
+        }
+    )
+
+
+BINARY_FORMATS = {"f32": "float32", "f16": "float16", "u8": "uint8"}
+
+
+def response_format() -> str | None:
+    """
+    Negotiates the response encoding. `?format=json|f32|f16|u8` takes precedence,
+    otherwise clients that accept `application/octet-stream` over JSON get float16.
+    Returns the binary dtype to encode with, or None for JSON.
+    """
+    requested = request.args.get("format")
+    if requested is not None:
+        if requested == "json":
+            return None
+        if requested not in BINARY_FORMATS:
+            expected = ["json", *BINARY_FORMATS]
+            raise ValueError(f"unknown format={requested!r}, expected {expected}")
+        return BINARY_FORMATS[requested]
+    best = request.accept_mimetypes.best_match(["application/json", BINARY_MIMETYPE])
+    return "float16" if best == BINARY_MIMETYPE else None
+
+
+def make_attention_response(
+    attention_information, binary_dtype: str | None
+) -> Response:
+    if binary_dtype is not None:
+        with STAGE_SECONDS.time(stage="binary_encode"):
+            body = binarize_objects(attention_information, dtype=binary_dtype)
+        response = Response(body, mimetype=BINARY_MIMETYPE)
+    else:
+        with STAGE_SECONDS.time(stage="detensorize"):
+            attention_information = detensorize_objects(attention_information)
+        with STAGE_SECONDS.time(stage="json_encode"):
+            response = jsonify(attention_information.to_dict())
+    response.vary.add("Accept")
+    return response
+
+
+def parse_range(value: str) -> tuple[int | None, int | None]:
+    """Parses `a:b`, `a:`, `:b` or `a` (a single index) into (start, stop)."""
+    start, sep, stop = value.partition(":")
+    start = int(start) if start.strip() else None
+    if not sep:
+        if start is None:
+            raise ValueError("empty range")
+        return start, start + 1
+    return start, int(stop) if stop.strip() else None
+
+
+def parse_slice(value: str | None, length: int) -> slice:
+    """Like `parse_range`, as a bounds-checked slice over `length` items."""
+    if value is None:
+        return slice(0, length)
+    start, stop, _ = slice(*parse_range(value)).indices(length)
+    if start >= stop:
+        raise ValueError(f"empty range {value!r} for length {length}")
+    return slice(start, stop)
+
+
+def is_true(value: str | None) -> bool:
+    return value is not None and value.lower() in ("1", "true", "yes")
+
+
+def optional_arg(name: str, cast: type):
+    """Unlike `request.args.get(name, type=...)`, raises on malformed values
+    instead of silently ignoring them."""
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        return cast(value)
+    except ValueError:
+        raise ValueError(f"malformed {name}={value!r}, expected {cast.__name__}")
+
+
+def requested_model() -> RegisteredModel:
+    """The model of `?model=...`, loading it if needed. Raises `KeyError` for models
+    that are not configured."""
+    return REGISTRY.get(request.args.get("model", MODEL_NAME))
+
+
+def check_prompt(mt: ModelandTokenizer, prompt: str | None) -> int:
+    """Raises `ValueError` for prompts the model can not run, so that they get a
+    400 instead of failing in the model. Returns the number of tokens."""
+    if not prompt:
+        raise ValueError("missing prompt")
+    n_tokens = len(mt.tokenizer(prompt).input_ids)
+    max_positions = mt.max_positions
+    if max_positions is not None and n_tokens > max_positions:
+        raise ValueError(
+            f"prompt of {n_tokens} tokens is longer than the {max_positions} "
+            f"positions of {mt.name}"
+        )
+    return n_tokens
+
+
+def schedule(model: RegisteredModel, prompt: str, **kwargs):
+    """Runs the prompt through the model's scheduler. If the model was evicted in
+    the meantime, it is loaded again."""
+    try:
+        return model.scheduler(prompt, **kwargs)
+    except SchedulerClosed:
+        return REGISTRY.get(model.mt.name).scheduler(prompt, **kwargs)
+
+
+# an edit is only recomputed incrementally if at least this fraction of its tokens
+# are shared with the session's last prompt. otherwise a batched forward, which can
+# also be answered from the cache, costs about the same
+SESSION_MIN_SHARED = 0.5
+
+
+def attention_for_session(
+    model: RegisteredModel, session: str, prompt: str, value_weighted: bool
+):
+    """
+    Prompts of a session are usually small edits of the previous one, so only the
+    rows of the tokens after the shared prefix are recomputed. Prompts that share
+    little with the previous one go through the scheduler like any other.
+    """
+    mt = model.mt
+    session = f"{mt.name}/{session}"
+    input_ids = mt.tokenizer(prompt).input_ids
+    try:
+        previous = SESSIONS.get(session)
+    except KeyError:
+        previous = None
+    n_shared = reusable_prefix_length(previous, input_ids, value_weighted)
+
+    attention_information = None
+    if n_shared > 0 and n_shared >= SESSION_MIN_SHARED * len(input_ids):
+        key = ATTENTION_CACHE.make_key(mt, prompt, value_weighted=value_weighted)
+        attention_information = ATTENTION_CACHE.get(key)
+        if attention_information is None:
+            waiting = time.perf_counter()
+            with model.scheduler.model_lock:
+                STAGE_SECONDS.observe(
+                    time.perf_counter() - waiting, stage="queue_wait"
+                )
+                attention_information, state = get_attention_matrices_incremental(
+                    prompt=prompt,
+                    mt=mt,
+                    previous=previous,
+                    value_weighted=value_weighted,
+                )
+            ATTENTION_CACHE.put(key, attention_information)
+            SESSIONS.put(state, result_id=session)
             return attention_information
+    if attention_information is None:
+        attention_information = schedule(model, prompt, value_weighted=value_weighted)
+    # keep the rows for the next edit, its kv cache is rebuilt if it is needed
+    state = PromptState(
+        input_ids=input_ids,
+        past_key_values=None,
+        attention_information=attention_information,
+        value_weighted=value_weighted,
+    )
+    SESSIONS.put(state, result_id=session)
+    return attention_information
 
 
 @app.route("/attnmatrix")
+@admitted
 def attnmatrix():
     prompt = request.args.get("prompt")
-    print(f"{prompt=}")
+    logger.info(f"{prompt=}")
+    value_weighted = is_true(request.args.get("value_weighted"))
+    # per-(layer, head) statistics instead of the matrices
+    summary = is_true(request.args.get("summary"))
+    try:
+        binary_dtype = response_format()
+        # rows as their top-k and/or >= threshold entries, CSR layout
+        top_k = optional_arg("top_k", int)
+        threshold = optional_arg("threshold", float)
+        if top_k is not None and top_k <= 0:
+            raise ValueError(f"top_k must be positive, got {top_k}")
+        # only compute the attention rows of these target tokens
+        rows = request.args.get("rows")
+        rows = parse_range(rows) if rows is not None else None
+        sparse = top_k is not None or threshold is not None
+        if sum([sparse, rows is not None, summary]) > 1:
+            raise ValueError("only one of top_k/threshold, rows and summary can be set")
+        model = requested_model()
+        n_tokens = check_prompt(model.mt, prompt)
+        # checked here, a bad range must not fail the prompts batched with this one
+        if rows is not None and len(range(*slice(*rows).indices(n_tokens))) == 0:
+            raise ValueError(f"empty range of rows {rows} for {n_tokens} tokens")
+    except (ValueError, KeyError) as error:
+        return jsonify({"error": error.args[0]}), 400
+
+    session = request.args.get("session")
+    if rows is not None:
+        attention_information = schedule(
+            model, prompt, value_weighted=value_weighted, rows=rows
+        )
+    elif summary:
+        attention_information = schedule(
+            model,
+            prompt,
+            value_weighted=value_weighted,
+            summary=True,
+            summary_argmax=is_true(request.args.get("argmax")),
+        )
+        return make_attention_response(attention_information, binary_dtype)
+    elif sparse:
+        attention_information = schedule(
+            model,
+            prompt,
+            value_weighted=value_weighted,
+            top_k=top_k,
+            threshold=threshold,
+        )
+    elif session is not None:
+        attention_information = attention_for_session(
+            model, session, prompt, value_weighted
+        )
+    else:
+        attention_information = schedule(model, prompt, value_weighted=value_weighted)
+
+    if is_true(request.args.get("lazy")):
+        # only metadata now, the matrices are fetched per (layer, head) later
+        return jsonify(
+            {
+                "result_id": RESULT_STORE.put(attention_information),
+                "prompt": attention_information.prompt,
+                "tokenized_prompt": attention_information.tokenized_prompt,
+                "shape": list(attention_information.shape),
+                "rows": getattr(attention_information, "rows", None),
+            }
+        )
+    return make_attention_response(attention_information, binary_dtype)
+
+
+def server_sent_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.route("/attnmatrix/stream")
+def attnmatrix_stream():
+    """
+    Server-Sent Events version of `/attnmatrix`: a `tokens` event, then one `layer`
+    event per layer, of shape (heads, tokens, tokens), as soon as that layer's
+    attention is computed, and finally a `done` event.
+    """
+    prompt = request.args.get("prompt")
+    if is_true(request.args.get("value_weighted")):
+        return jsonify({"error": "value_weighted is not supported for streaming"}), 400
+    logger.info(f"streaming {prompt=}")
+    # the slot is held until the stream is closed, not just until we return
+    ADMISSION.acquire()
+    try:
+        model = requested_model()
+        check_prompt(model.mt, prompt)
+        tokenized_prompt, layers = stream_attention_matrices(
+            prompt=prompt, mt=model.mt, lock=model.scheduler.model_lock
+        )
+    except (ValueError, KeyError) as error:
+        ADMISSION.release()
+        return jsonify({"error": error.args[0]}), 400
+    except Exception:
+        ADMISSION.release()
+        raise
+
+    def events():
+        yield server_sent_event(
+            "tokens", {"prompt": prompt, "tokenized_prompt": tokenized_prompt}
+        )
+        try:
+            for layer, attention in layers:
+                yield server_sent_event(
+                    "layer", {"layer": layer, "attention": attention.tolist()}
+                )
+        except Exception as error:
+            yield server_sent_event("error", {"error": str(error)})
+            return
+        yield server_sent_event("done", {})
+
+    response = Response(
+        stream_with_context(events()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    response.call_on_close(ADMISSION.release)
+    return response
+
+
+@app.route("/attnmatrix/<result_id>/<int:layer>/<int:head>")
+def attnmatrix_slice(result_id: str, layer: int, head: int):
+    """
+    Serves `get_attn_matrix(layer, head)` of a stored result, optionally only the
+    target (query) token rows given by `?rows=a:b`.
+    """
+    try:
+        binary_dtype = response_format()
+        attention_information = RESULT_STORE.get(result_id)
+    except ValueError as error:
+        return jsonify({"error": str(error)}), 400
+    except KeyError:
+        return jsonify({"error": f"unknown or expired result_id={result_id!r}"}), 404
 
-    # attention_information = get_attention_matrices(
-    #     prompt=prompt,
-    #     mt=MT,
-    # )
-    attention_information = pool_for_attention_info(prompt)
+    n_layer, n_head, n_rows, _ = attention_information.shape
+    if not (0 <= layer < n_layer and 0 <= head < n_head):
+        return jsonify({"error": f"{layer=}, {head=} out of range"}), 400
+    # results of `/attnmatrix?rows=a:b` only hold the rows from `a` on
+    row_offset = (getattr(attention_information, "rows", None) or [0])[0]
+    try:
+        rows = parse_slice(request.args.get("rows"), n_rows)
+    except ValueError as error:
+        return jsonify({"error": str(error)}), 400
 
-    attention_information = detensorize_objects(attention_information)
-    return jsonify(attention_information.to_dict())
+    attention_matrix = attention_information.get_attn_matrix(layer, head)[rows]
+    metadata = {
+        "layer": layer,
+        "head": head,
+        "rows": [row_offset + rows.start, row_offset + rows.stop],
+    }
+    if binary_dtype is not None:
+        return Response(
+            encode_binary(
+                metadata=metadata,
+                arrays={"attention_matrix": attention_matrix},
+                dtype=binary_dtype,
+            ),
+            mimetype=BINARY_MIMETYPE,
+        )
+    return jsonify({**metadata, "attention_matrix": attention_matrix.tolist()})
 
 
 if __name__ == "__main__":
     print(f"host={URL}, port={BACKEND_PORT}")
-    app.run(host=URL, port=BACKEND_PORT, debug=True, use_reloader=False)
+    if N_WORKERS > 1:
+        if SHARED_WEIGHTS is not None:
+            prepare_shared_weights()
+        serve_prefork(
+            init_worker,
+            app,
+            host=URL,
+            port=BACKEND_PORT,
+            n_workers=N_WORKERS,
+            worker_cores=WORKER_CORES,
+        )
+    elif config["APP"].get("server", "flask") == "uvicorn":
+        # spare threads answer the 503s, /metrics and /stats while every admitted
+        # request is busy
+        serve_asgi(
+            app,
+            host=URL,
+            port=BACKEND_PORT,
+            workers=ADMISSION.max_in_flight + ASGI_SPARE_THREADS,
+        )
+    else:
+        app.run(host=URL, port=BACKEND_PORT, debug=True, use_reloader=False)
@@ -0,0 +1,242 @@
+"""Replays a JSONL log of `/attnmatrix` requests against the backend.
+
+    cd backend
+    python -m benchmarks.load_test log.jsonl --url http://localhost:5050 --concurrency 8
+    python -m benchmarks.load_test log.jsonl --in-process --rate 20 --n-requests 500
+
+Every line of the log is a JSON object. Its `--prompt-field` (default `prompt`) is
+sent as the prompt, `path` (default `/attnmatrix`) as the route, and `params` (an
+object, if present) as additional query parameters, e.g. `{"value_weighted": true}`.
+Other fields are ignored, so logs with extra metadata can be replayed as they are.
+
+Without `--rate`, `--concurrency` clients send requests back to back (closed loop).
+With `--rate`, requests arrive at that many per second on average, Poisson
+distributed, whether or not earlier requests have finished (open loop). Latency is
+measured from the time a request was due, so requests waiting for a free client
+count as slow.
+"""
+import argparse
+import json
+import logging
+import math
+import random
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Optional
+
+from src.utils import logging_utils
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class LoggedRequest:
+    path: str
+    params: dict[str, Any]
+
+
+@dataclass(frozen=True)
+class Sample:
+    status: int  # 0 if the request failed without a response
+    latency_s: float
+    nbytes: int
+
+
+def load_requests(path: Path, prompt_field: str = "prompt") -> list[LoggedRequest]:
+    requests = []
+    with open(path) as handle:
+        for line in handle:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            params = {"prompt": record[prompt_field], **record.get("params", {})}
+            params = {
+                key: str(value).lower() if isinstance(value, bool) else value
+                for key, value in params.items()
+            }
+            requests.append(
+                LoggedRequest(path=record.get("path", "/attnmatrix"), params=params)
+            )
+    assert len(requests) > 0, f"no requests in {path}"
+    return requests
+
+
+class HttpClient:
+    def __init__(self, base_url: str, timeout: float = 300) -> None:
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+
+    def send(self, logged: LoggedRequest) -> tuple[int, int]:
+        """Returns the status code and the size of the response body."""
+        url = f"{self.base_url}{logged.path}?{urllib.parse.urlencode(logged.params)}"
+        try:
+            with urllib.request.urlopen(url, timeout=self.timeout) as response:
+                return response.status, len(response.read())
+        except urllib.error.HTTPError as error:
+            return error.code, len(error.read())
+
+
+class InProcessClient:
+    """Calls the Flask app directly, which loads the model in this process."""
+
+    def __init__(self) -> None:
+        from app import app
+
+        self.client = app.test_client()
+
+    def send(self, logged: LoggedRequest) -> tuple[int, int]:
+        response = self.client.get(logged.path, query_string=logged.params)
+        return response.status_code, len(response.get_data())
+
+
+def replay(
+    client: Any,
+    requests: list[LoggedRequest],
+    n_requests: int,
+    concurrency: int,
+    rate: Optional[float] = None,
+    seed: int = 0,
+) -> tuple[list[Sample], float]:
+    """Sends `n_requests` requests, cycling through `requests`. Returns the samples
+    and the wall-clock seconds it took."""
+    rng = random.Random(seed)
+    samples: list[Sample] = []
+    lock = threading.Lock()
+
+    def send(logged: LoggedRequest, due: Optional[float] = None) -> None:
+        due = time.perf_counter() if due is None else due
+        try:
+            status, nbytes = client.send(logged)
+        except Exception as error:
+            logger.debug(f"request failed: {error}")
+            status, nbytes = 0, 0
+        sample = Sample(
+            status=status, latency_s=time.perf_counter() - due, nbytes=nbytes
+        )
+        with lock:
+            samples.append(sample)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        due = start
+        for i in range(n_requests):
+            logged = requests[i % len(requests)]
+            if rate is not None:
+                due += rng.expovariate(rate)
+                time.sleep(max(0.0, due - time.perf_counter()))
+                pool.submit(send, logged, due)
+            else:
+                # closed loop: at most `concurrency` requests outstanding, each
+                # one timed from when a client picks it up
+                pool.submit(send, logged)
+    return samples, time.perf_counter() - start
+
+
+def percentile(values: list[float], q: float) -> float:
+    """Nearest-rank percentile, `q` in [0, 100]."""
+    if len(values) == 0:
+        return float("nan")
+    values = sorted(values)
+    rank = max(0, min(len(values) - 1, math.ceil(q * len(values) / 100) - 1))
+    return values[rank]
+
+
+def summarize(samples: list[Sample], duration: float) -> dict[str, Any]:
+    ok = [sample for sample in samples if 200 <= sample.status < 300]
+    rejected = [sample for sample in samples if sample.status == 503]
+    errors = len(samples) - len(ok) - len(rejected)
+    latencies = [sample.latency_s for sample in ok]
+    payloads = [sample.nbytes for sample in ok]
+    statuses: dict[str, int] = {}
+    for sample in samples:
+        statuses[str(sample.status)] = statuses.get(str(sample.status), 0) + 1
+    return {
+        "requests": len(samples),
+        "duration_s": duration,
+        "throughput_rps": len(ok) / duration if duration > 0 else 0.0,
+        "latency_s": {
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "max": max(latencies, default=float("nan")),
+        },
+        "error_rate": errors / len(samples),
+        "reject_rate": len(rejected) / len(samples),
+        "payload_bytes": {
+            "mean": sum(payloads) / len(payloads) if payloads else 0.0,
+            "p95": percentile(payloads, 95),
+            "total": sum(payloads),
+        },
+        "statuses": statuses,
+    }
+
+
+def main(args: argparse.Namespace) -> None:
+    logging_utils.configure(args=args)
+    requests = load_requests(args.log, prompt_field=args.prompt_field)
+    if args.in_process:
+        client = InProcessClient()
+    else:
+        client = HttpClient(args.url, timeout=args.timeout)
+    n_requests = args.n_requests if args.n_requests is not None else len(requests)
+
+    logger.info(
+        f"replaying {n_requests} requests from {args.log} with "
+        f"{args.concurrency} clients"
+        + (f" at {args.rate}/s" if args.rate is not None else "")
+    )
+    samples, duration = replay(
+        client,
+        requests,
+        n_requests=n_requests,
+        concurrency=args.concurrency,
+        rate=args.rate,
+        seed=args.seed,
+    )
+    summary = summarize(samples, duration)
+    print(json.dumps(summary, indent=2))
+    if args.out is not None:
+        args.out.parent.mkdir(parents=True, exist_ok=True)
+        with open(args.out, "w") as handle:
+            json.dump(
+                {
+                    "settings": {
+                        key: str(value) if isinstance(value, Path) else value
+                        for key, value in vars(args).items()
+                    },
+                    "summary": summary,
+                },
+                handle,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="replay requests against the backend")
+    parser.add_argument("log", type=Path, help="JSONL file of requests")
+    parser.add_argument(
+        "--url", default="http://localhost:5050", help="backend to send requests to"
+    )
+    parser.add_argument(
+        "--in-process",
+        action="store_true",
+        default=False,
+        help="call the app in this process instead of over HTTP",
+    )
+    parser.add_argument("--prompt-field", default="prompt", help="field to send")
+    parser.add_argument("--n-requests", type=int, default=None, help="default: all")
+    parser.add_argument("--concurrency", type=int, default=4, help="parallel clients")
+    parser.add_argument(
+        "--rate", type=float, default=None, help="requests per second (open loop)"
+    )
+    parser.add_argument("--timeout", type=float, default=300, help="seconds")
+    parser.add_argument("--out", type=Path, default=None, help="write the report here")
+    parser.add_argument("--seed", type=int, default=0)
+    logging_utils.add_logging_args(parser)
+    main(parser.parse_args())
@@ -0,0 +1,314 @@
+"""Benchmarks of the backend hot paths on tiny random models, on the CPU.
+
+    cd backend
+    python -m benchmarks.run --out benchmarks/results.json
+    python -m benchmarks.run --out /tmp/results.json --baseline benchmarks/results.json
+
+Every case is timed `--repeat` times after a warmup call, and the results are written
+as JSON. With `--baseline`, the median of every case is compared to the same case in
+the baseline file, and cases slower by more than `--tolerance` are reported as
+regressions (exit code 1 with `--fail-on-regression`). No baseline is shipped, as
+timings only compare on the same machine: create one by running the benchmarks on
+the reference commit, and keep the results file (with its `environment`) as the
+baseline.
+"""
+import argparse
+import json
+import logging
+import platform
+import random
+import statistics
+import sys
+import time
+from pathlib import Path
+from typing import Any, Callable
+
+import torch
+from benchmarks.tiny_models import (
+    ARCHITECTURES,
+    TinyMambaBlock,
+    make_prompt,
+    make_tiny_model,
+)
+from src.attention import get_attention_matrices
+from src.functional import (
+    detensorize_objects,
+    find_token_range,
+    get_h,
+    get_h_batched,
+    logit_lens,
+    predict_next_token,
+)
+from src.hooking.mamba import MambaBlockForwardPatcher
+from src.models import ModelandTokenizer
+from src.utils import logging_utils
+
+logger = logging.getLogger(__name__)
+
+PROMPT_LENGTHS = (16, 64, 256)
+BATCH_SIZES = (1, 4, 16)
+QUICK_PROMPT_LENGTHS = (16, 64)
+QUICK_BATCH_SIZES = (1, 4)
+
+
+def time_call(fn: Callable[[], Any], repeat: int, warmup: int = 1) -> dict:
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {
+        "median_s": statistics.median(times),
+        "min_s": min(times),
+        "mean_s": statistics.fmean(times),
+        "repeat": repeat,
+    }
+
+
+def case_key(case: dict) -> str:
+    return "/".join(
+        [case["name"], case["architecture"]]
+        + [f"{param}={case[param]}" for param in ("length", "batch_size")]
+    )
+
+
+def model_cases(
+    mt: ModelandTokenizer,
+    architecture: str,
+    lengths: tuple[int, ...],
+    batch_sizes: tuple[int, ...],
+    rng: random.Random,
+) -> list[tuple[dict, Callable[[], Any]]]:
+    """(case, function to time) of every benchmark that needs a model."""
+    vocab_size = len(mt.tokenizer)
+    cases = []
+
+    def add(name: str, length: int, batch_size: int, fn: Callable[[], Any]) -> None:
+        case = {
+            "name": name,
+            "architecture": architecture,
+            "length": length,
+            "batch_size": batch_size,
+        }
+        cases.append((case, fn))
+
+    for length in lengths:
+        for batch_size in batch_sizes:
+            prompts = [make_prompt(length, rng, vocab_size) for _ in range(batch_size)]
+            add(
+                "get_attention_matrices",
+                length,
+                batch_size,
+                lambda prompts=prompts: get_attention_matrices(prompts, mt),
+            )
+            add(
+                "get_attention_matrices_value_weighted",
+                length,
+                batch_size,
+                lambda prompts=prompts: get_attention_matrices(
+                    prompts, mt, value_weighted=True
+                ),
+            )
+            add(
+                "predict_next_token",
+                length,
+                batch_size,
+                lambda prompts=prompts, batch_size=batch_size: predict_next_token(
+                    mt, prompts, k=5, batch_size=batch_size
+                ),
+            )
+            subjects = [
+                " ".join(prompt.split()[length // 2 : length // 2 + 2])
+                for prompt in prompts
+            ]
+            add(
+                "get_h_batched",
+                length,
+                batch_size,
+                lambda prompts=prompts, subjects=subjects: get_h_batched(
+                    mt, prompts, subjects, mt.layer_names, batch_size=len(prompts)
+                ),
+            )
+            results = get_attention_matrices(prompts, mt)
+            add(
+                "detensorize_json",
+                length,
+                batch_size,
+                lambda results=results: [
+                    json.dumps(detensorize_objects(result).to_dict())
+                    for result in results
+                ],
+            )
+
+        prompt = make_prompt(length, rng, vocab_size)
+        words = prompt.split()
+        subject = " ".join(words[length // 2 : length // 2 + 2])
+        add(
+            "find_token_range",
+            length,
+            1,
+            lambda prompt=prompt, subject=subject: find_token_range(
+                prompt, subject, tokenizer=mt.tokenizer
+            ),
+        )
+        layers = mt.layer_names
+        add(
+            "get_h",
+            length,
+            1,
+            lambda prompt=prompt, subject=subject: get_h(mt, prompt, subject, layers),
+        )
+        h = get_h(mt, prompt, subject, [layers[-1]])[layers[-1]]
+        add(
+            "logit_lens",
+            length,
+            1,
+            lambda h=h: logit_lens(mt, h, interested_tokens=list(range(10)), k=10),
+        )
+    return cases
+
+
+def mamba_cases(
+    lengths: tuple[int, ...], batch_sizes: tuple[int, ...]
+) -> list[tuple[dict, Callable[[], Any]]]:
+    block = TinyMambaBlock().eval()
+    d_model = block.in_proj.in_features
+    cases = []
+    for length in lengths:
+        for batch_size in batch_sizes:
+            x = torch.randn(batch_size, length, d_model)
+            patch_spec = {length // 2: torch.randn(block.args.d_inner)}
+            variants = {
+                "mamba_patcher": MambaBlockForwardPatcher(),
+                "mamba_patcher_patch_retain": MambaBlockForwardPatcher(
+                    patch_spec=patch_spec, patch_hook="ssm_after_silu", retainer={}
+                ),
+            }
+            for name, patcher in variants.items():
+                case = {
+                    "name": name,
+                    "architecture": "mamba_stand_in",
+                    "length": length,
+                    "batch_size": batch_size,
+                }
+                cases.append((case, lambda patcher=patcher, x=x: patcher(block, x)))
+    return cases
+
+
+def compare(results: list[dict], baseline: list[dict], tolerance: float) -> list[dict]:
+    """The cases whose median is more than `tolerance` (relative) slower than in
+    `baseline`. Cases missing from either side are skipped."""
+    baseline_medians = {case_key(case): case["median_s"] for case in baseline}
+    regressions = []
+    for case in results:
+        key = case_key(case)
+        if key not in baseline_medians:
+            continue
+        ratio = case["median_s"] / baseline_medians[key]
+        case["baseline_ratio"] = ratio
+        if ratio > 1 + tolerance:
+            regressions.append(case)
+    return regressions
+
+
+def environment() -> dict:
+    import transformers
+
+    return {
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "torch": torch.__version__,
+        "transformers": transformers.__version__,
+        "threads": torch.get_num_threads(),
+        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+
+
+@torch.inference_mode()
+def run(args: argparse.Namespace) -> list[dict]:
+    lengths = QUICK_PROMPT_LENGTHS if args.quick else PROMPT_LENGTHS
+    batch_sizes = QUICK_BATCH_SIZES if args.quick else BATCH_SIZES
+    rng = random.Random(args.seed)
+    torch.manual_seed(args.seed)
+
+    cases = []
+    for architecture in args.architectures:
+        mt = make_tiny_model(architecture, n_layer=args.n_layer, d_model=args.d_model)
+        cases += model_cases(mt, architecture, lengths, batch_sizes, rng)
+    cases += mamba_cases(lengths, batch_sizes)
+    if args.filter is not None:
+        cases = [(case, fn) for case, fn in cases if args.filter in case["name"]]
+
+    results = []
+    for case, fn in cases:
+        case.update(time_call(fn, repeat=args.repeat))
+        logger.info(f"{case_key(case)}: {case['median_s'] * 1000:.3f} ms")
+        results.append(case)
+    return results
+
+
+def main(args: argparse.Namespace) -> None:
+    logging_utils.configure(args=args)
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    results = run(args)
+    regressions = []
+    if args.baseline is not None:
+        with open(args.baseline) as handle:
+            baseline = json.load(handle)["results"]
+        regressions = compare(results, baseline, tolerance=args.tolerance)
+        for case in regressions:
+            logger.warning(
+                f"regression {case_key(case)}: {case['baseline_ratio']:.2f}x baseline"
+            )
+        logger.info(f"{len(regressions)} regressions against {args.baseline}")
+
+    args.out.parent.mkdir(parents=True, exist_ok=True)
+    with open(args.out, "w") as handle:
+        json.dump(
+            {
+                "environment": environment(),
+                "settings": {
+                    "n_layer": args.n_layer,
+                    "d_model": args.d_model,
+                    "quick": args.quick,
+                },
+                "results": results,
+            },
+            handle,
+            indent=2,
+        )
+    logger.info(f"wrote {len(results)} results to {args.out}")
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark the backend on the CPU")
+    parser.add_argument(
+        "--out", type=Path, default=Path("benchmarks/results.json"), help="output file"
+    )
+    parser.add_argument(
+        "--baseline", type=Path, default=None, help="results file to compare to"
+    )
+    parser.add_argument(
+        "--tolerance", type=float, default=0.2, help="allowed relative slowdown"
+    )
+    parser.add_argument("--fail-on-regression", action="store_true", default=False)
+    parser.add_argument(
+        "--architectures", nargs="+", default=list(ARCHITECTURES), help="models"
+    )
+    parser.add_argument("--filter", default=None, help="only cases with this name")
+    parser.add_argument(
+        "--quick", action="store_true", default=False, help="fewer, smaller cases"
+    )
+    parser.add_argument("--repeat", type=int, default=5, help="timed calls per case")
+    parser.add_argument("--n-layer", type=int, default=4)
+    parser.add_argument("--d-model", type=int, default=64)
+    parser.add_argument("--threads", type=int, default=None, help="torch threads")
+    parser.add_argument("--seed", type=int, default=0)
+    logging_utils.add_logging_args(parser)
+    main(parser.parse_args())
@@ -0,0 +1,129 @@
+"""Tiny randomly initialized models and an offline word-level tokenizer, so the
+benchmarks run on a CPU without downloading anything. The numbers measure the code
+around the model (hooks, copies, decoding, serialization) more than the model."""
+import random
+
+import torch
+import torch.nn.functional as F
+from src.models import ModelandTokenizer
+
+ARCHITECTURES = ("gpt2", "llama", "gpt_neox")
+
+EOS_TOKEN = "<|endoftext|>"
+UNK_TOKEN = "[UNK]"
+
+
+def make_tokenizer(vocab_size: int = 512):
+    """A fast word-level tokenizer over the words `w0`, `w1`, ... split on spaces,
+    with offsets, as `find_token_range` and `get_h` need them."""
+    from tokenizers import Tokenizer, models, pre_tokenizers
+    from transformers import PreTrainedTokenizerFast
+
+    vocab = {EOS_TOKEN: 0, UNK_TOKEN: 1}
+    for i in range(vocab_size - len(vocab)):
+        vocab[f"w{i}"] = len(vocab)
+    tokenizer = Tokenizer(models.WordLevel(vocab=vocab, unk_token=UNK_TOKEN))
+    tokenizer.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        eos_token=EOS_TOKEN,
+        unk_token=UNK_TOKEN,
+        pad_token=EOS_TOKEN,
+    )
+    return tokenizer
+
+
+def make_config(architecture: str, vocab_size: int, n_layer: int, d_model: int):
+    from transformers import GPT2Config, GPTNeoXConfig, LlamaConfig
+
+    n_head = max(1, d_model // 16)
+    if architecture == "gpt2":
+        return GPT2Config(
+            vocab_size=vocab_size,
+            n_positions=1024,
+            n_embd=d_model,
+            n_layer=n_layer,
+            n_head=n_head,
+        )
+    if architecture == "llama":
+        return LlamaConfig(
+            vocab_size=vocab_size,
+            hidden_size=d_model,
+            intermediate_size=4 * d_model,
+            num_hidden_layers=n_layer,
+            num_attention_heads=n_head,
+            max_position_embeddings=1024,
+        )
+    if architecture == "gpt_neox":
+        return GPTNeoXConfig(
+            vocab_size=vocab_size,
+            hidden_size=d_model,
+            intermediate_size=4 * d_model,
+            num_hidden_layers=n_layer,
+            num_attention_heads=n_head,
+            max_position_embeddings=1024,
+        )
+    raise ValueError(f"unknown architecture {architecture}, one of {ARCHITECTURES}")
+
+
+def make_tiny_model(
+    architecture: str,
+    n_layer: int = 4,
+    d_model: int = 64,
+    vocab_size: int = 512,
+    seed: int = 0,
+) -> ModelandTokenizer:
+    from transformers import AutoModelForCausalLM
+
+    torch.manual_seed(seed)
+    tokenizer = make_tokenizer(vocab_size)
+    config = make_config(architecture, len(tokenizer), n_layer, d_model)
+    config._name_or_path = f"tiny-{architecture}"
+    # the attention endpoints need the attention weights, which sdpa does not return
+    model = AutoModelForCausalLM.from_config(config, attn_implementation="eager")
+    model.eval()
+    return ModelandTokenizer(model=model, tokenizer=tokenizer)
+
+
+def make_prompt(n_tokens: int, rng: random.Random, vocab_size: int = 512) -> str:
+    return " ".join(f"w{rng.randrange(vocab_size - 2)}" for _ in range(n_tokens))
+
+
+class TinyMambaBlock(torch.nn.Module):
+    """
+    Stand-in with the attributes `MambaBlockForwardPatcher` uses (`in_proj`,
+    `conv1d`, `ssm`, `out_proj` and `args.d_inner`), so the patcher can be timed
+    without `mamba_ssm`. The `ssm` is a fixed exponential moving average scan
+    instead of the selective scan.
+    """
+
+    class Args:
+        def __init__(self, d_inner: int) -> None:
+            self.d_inner = d_inner
+
+    def __init__(self, d_model: int = 64, expand: int = 2, d_conv: int = 4) -> None:
+        super().__init__()
+        d_inner = expand * d_model
+        self.args = self.Args(d_inner)
+        self.in_proj = torch.nn.Linear(d_model, 2 * d_inner, bias=False)
+        self.conv1d = torch.nn.Conv1d(
+            d_inner, d_inner, kernel_size=d_conv, groups=d_inner, padding=d_conv - 1
+        )
+        self.out_proj = torch.nn.Linear(d_inner, d_model, bias=False)
+        self.decay = torch.nn.Parameter(torch.rand(d_inner))
+
+    def ssm(self, x: torch.Tensor) -> torch.Tensor:
+        decay = torch.sigmoid(self.decay)
+        state = torch.zeros_like(x[:, 0])
+        states = []
+        for t in range(x.shape[1]):
+            state = decay * state + (1 - decay) * x[:, t]
+            states.append(state)
+        return torch.stack(states, dim=1)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        l = x.shape[1]
+        x, res = self.in_proj(x).split([self.args.d_inner, self.args.d_inner], dim=-1)
+        x = self.conv1d(x.transpose(1, 2))[:, :, :l].transpose(1, 2)
+        y = self.ssm(F.silu(x)) * F.silu(res)
+        return self.out_proj(y)
@@ -1,9 +1,17 @@
+import logging
+import time
 from dataclasses import dataclass, fields
+from typing import Any, Optional, Union
 
 import numpy as np
+import src.utils.tokenizer_utils as tokenizer_utils
 import torch
 from dataclasses_json import DataClassJsonMixin
+from src.hooking.attention import capture_attention
 from src.models import ModelandTokenizer
+from src.utils.metrics import STAGE_SECONDS, TOKENS_PROCESSED
+
+logger = logging.getLogger(__name__)
 
 
 @dataclass(frozen=False)
@@ -11,6 +19,9 @@ class AttentionInformation(DataClassJsonMixin):
     prompt: str
     tokenized_prompt: list[str]
     attention_matrices: np.ndarray
+    # [start, stop) of the target tokens if only those rows of the attention
+    # matrices were computed, see `get_attention_rows`
+    rows: Optional[list[int]] = None
 
     def _init__(
         self, prompt: str, tokenized_prompt: list[str], attention_matrices: torch.tensor
@@ -29,39 +40,569 @@ class AttentionInformation(DataClassJsonMixin):
         self.tokenized_prompt = tokenized_prompt
         self.attention_matrices = attention_matrices
 
+    @property
+    def shape(self) -> tuple[int, ...]:
+        return self.attention_matrices.shape
+
     def get_attn_matrix(self, layer: int, head: int) -> torch.tensor:
         return self.attention_matrices[layer, head]
 
 
+@dataclass(frozen=False)
+class SparseAttentionInformation(DataClassJsonMixin):
+    """
+    Attention matrices with only the top-k and/or above-threshold entries of each row,
+    in CSR layout. The rows are the (layer, head, target token) triples flattened in
+    that order: the entries of row `r` are `indices/values[indptr[r] : indptr[r + 1]]`
+    where `indices` holds the source token of each entry.
+    """
+
+    prompt: str
+    tokenized_prompt: list[str]
+    shape: list[int]  # of the dense matrices, (layers, heads, tokens, tokens)
+    indptr: np.ndarray  # (layers * heads * tokens + 1,)
+    indices: np.ndarray  # (n_entries,)
+    values: np.ndarray  # (n_entries,)
+
+    def _row(self, layer: int, head: int, target: int) -> int:
+        n_layer, n_head, n_tokens, _ = self.shape
+        return (layer * n_head + head) * n_tokens + target
+
+    def get_attn_row(
+        self, layer: int, head: int, target: int
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Returns the (source token indices, values) kept for the target token."""
+        row = self._row(layer, head, target)
+        start, end = self.indptr[row], self.indptr[row + 1]
+        return self.indices[start:end], self.values[start:end]
+
+    def get_attn_matrix(self, layer: int, head: int) -> np.ndarray:
+        """The dense (tokens, tokens) matrix, with zeros for the dropped entries."""
+        n_tokens = self.shape[-1]
+        first_row = self._row(layer, head, 0)
+        indptr = self.indptr[first_row : first_row + n_tokens + 1]
+        start, end = indptr[0], indptr[-1]
+        matrix = np.zeros((n_tokens, n_tokens), dtype=self.values.dtype)
+        targets = np.repeat(np.arange(n_tokens), np.diff(indptr))
+        matrix[targets, self.indices[start:end]] = self.values[start:end]
+        return matrix
+
+
+@dataclass(frozen=False)
+class AttentionHeadSummary(DataClassJsonMixin):
+    """
+    Per-(layer, head) statistics of the attention matrices, to pick interesting
+    heads without downloading the matrices. The scores are averaged over the target
+    tokens and have shape (layers, heads).
+    """
+
+    prompt: str
+    tokenized_prompt: list[str]
+    entropy: np.ndarray  # of each row, normalized to a distribution
+    previous_token: np.ndarray  # attention to the token right before the target
+    first_token: np.ndarray  # attention to the first token (BOS / attention sink)
+    diagonal: np.ndarray  # attention of the target to itself
+    # (layers, heads, tokens), most attended source per target, int16 (int32 past
+    # 32767 tokens). only computed if asked for, it grows with the prompt length
+    argmax: Optional[np.ndarray] = None
+
+
+def summarize_attention(
+    attentions: torch.Tensor, argmax: bool = False
+) -> dict[str, torch.Tensor]:
+    """
+    Computes the `AttentionHeadSummary` statistics of a (..., tokens, tokens)
+    attention tensor in a few batched ops on the tensor's device, with the `argmax`
+    of every row if `argmax` is set.
+    """
+    n_tokens = attentions.shape[-1]
+    distributions = attentions / attentions.sum(dim=-1, keepdim=True).clamp_min(1e-12)
+    previous_token = (
+        attentions.diagonal(offset=-1, dim1=-2, dim2=-1).mean(dim=-1)
+        if n_tokens > 1
+        else torch.zeros(attentions.shape[:-2], device=attentions.device)
+    )
+    stats = {
+        "entropy": torch.special.entr(distributions).sum(dim=-1).mean(dim=-1),
+        "previous_token": previous_token,
+        "first_token": attentions[..., 0].mean(dim=-1),
+        "diagonal": attentions.diagonal(dim1=-2, dim2=-1).mean(dim=-1),
+    }
+    if argmax:
+        index_dtype = torch.int16 if n_tokens <= 2**15 else torch.int32
+        stats["argmax"] = attentions.argmax(dim=-1).to(index_dtype)
+    return stats
+
+
+def sparsify_attention(
+    attentions: torch.Tensor,
+    top_k: Optional[int] = None,
+    threshold: Optional[float] = None,
+) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Keeps the `top_k` largest and/or the `>= threshold` entries of every row of a
+    causal (..., tokens, tokens) attention tensor. Runs vectorized on the tensor's
+    device, so only the kept entries need to be copied to the host.
+
+    Returns:
+        CSR (indptr, indices, values) over the rows of `attentions` flattened in order
+    """
+    assert top_k is not None or threshold is not None, "set top_k and/or threshold"
+    n_tokens = attentions.shape[-1]
+    positions = torch.arange(n_tokens, device=attentions.device)
+    if top_k is not None:
+        assert top_k > 0, "top_k must be positive"
+        values, indices = attentions.topk(k=min(top_k, n_tokens), dim=-1)
+    else:
+        values = attentions
+        indices = positions.expand_as(attentions)
+    # sources after the target are masked out by the model, never keep them
+    keep = indices <= positions[:, None]
+    if threshold is not None:
+        keep &= values >= threshold
+
+    counts = keep.flatten(end_dim=-2).sum(dim=-1)
+    indptr = torch.zeros(counts.numel() + 1, dtype=torch.long, device=counts.device)
+    indptr[1:] = counts.cumsum(dim=0)
+    # boolean indexing is row major, so the entries line up with `indptr`
+    return indptr, indices[keep], values[keep]
+
+
+def concat_csr(
+    pieces: list[tuple[torch.Tensor, torch.Tensor, torch.Tensor]]
+) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """Stacks the rows of several CSR (indptr, indices, values) in order."""
+    indptrs, offset = [pieces[0][0][:1]], 0
+    for indptr, _, _ in pieces:
+        indptrs.append(indptr[1:] + offset)
+        offset += indptr[-1]
+    return (
+        torch.cat(indptrs),
+        torch.cat([indices for _, indices, _ in pieces]),
+        torch.cat([values for _, _, values in pieces]),
+    )
+
+
 @torch.inference_mode()
 def get_attention_matrices(
-    prompt: str, mt: ModelandTokenizer, value_weighted: bool = False
-) -> torch.tensor:
+    prompt: Union[str, list[str]],
+    mt: ModelandTokenizer,
+    value_weighted: bool = False,
+    top_k: Optional[int] = None,
+    threshold: Optional[float] = None,
+    rows: Optional[tuple[Optional[int], Optional[int]]] = None,
+    summary: bool = False,
+    summary_argmax: bool = False,
+) -> Union[
+    AttentionInformation,
+    SparseAttentionInformation,
+    AttentionHeadSummary,
+    list[AttentionInformation],
+    list[SparseAttentionInformation],
+    list[AttentionHeadSummary],
+]:
     """
     Parameters:
-        prompt: str, input prompt
+        prompt: str or list[str], input prompt(s). A list is run as one padded batch
         mt: ModelandTokenizer, model and tokenizer
         value_weighted: bool.
             - False => will reuturn attention masks for each key-value pair (after softmax). This is the attention mask actually produced inside the model
             - True => will consider the value matrices to give a sense of the actual contribution of source tokens to the target token residual.
+        top_k, threshold: if either is set, only the top-k and/or >= threshold
+            entries of each row are kept, see SparseAttentionInformation
+        rows: (start, stop) range of target tokens. If set, only those rows are
+            computed, see `get_attention_rows`
+        summary: bool. If set, an AttentionHeadSummary is returned instead
+        summary_argmax: bool. If set, the summary includes the argmax of every row
+    Returns:
+        AttentionInformation (list of them if `prompt` is a list) with attention matrices of shape (layers, heads, tokens, tokens)
+    """
+    prompts = [prompt] if isinstance(prompt, str) else prompt
+    assert len(prompts) > 0 and all(
+        isinstance(p, str) for p in prompts
+    ), "Prompt must be a string or a non-empty list of strings"
+
+    sparse = top_k is not None or threshold is not None
+    if sum([sparse, rows is not None, summary]) > 1:
+        raise ValueError("only one of top_k/threshold, rows and summary can be set")
+    if rows is not None:
+        attention_information = [
+            get_attention_rows(p, mt, rows=rows, value_weighted=value_weighted)
+            for p in prompts
+        ]
+        if isinstance(prompt, str):
+            return attention_information[0]
+        return attention_information
+
+    # right padding keeps the positions of the real tokens the same as in an unbatched
+    # forward, and with causal attention the pad tokens never leak into them
+    with STAGE_SECONDS.time(stage="tokenization"):
+        with tokenizer_utils.set_padding_side(mt.tokenizer, padding_side="right"):
+            inputs = mt.tokenizer(
+                prompts,
+                return_tensors="pt",
+                padding="longest" if len(prompts) > 1 else False,
+            ).to(mt.device)
+    if "token_type_ids" in inputs:
+        inputs.pop("token_type_ids")
+
+    lengths = inputs.attention_mask.sum(dim=-1).tolist()
+    TOKENS_PROCESSED.inc(sum(lengths))
+    # value weighting needs the values of the layer, which are only read after the
+    # forward. without it, the rows can be sparsified/summarized on device layer by
+    # layer
+    reduce_on_device = (sparse or summary) and not value_weighted
+
+    # every layer's attention is moved out of the model as soon as it is computed,
+    # either into one preallocated host buffer (downcast and copied in one go) or
+    # reduced. the extra memory at any point is about one layer's attention
+    host_buffer: Optional[torch.Tensor] = None  # (batch, layers, heads, tokens, tokens)
+    reduced_layers: list[list] = [[] for _ in prompts]
+    n_head = None
+    # the copies wait for the layer's kernels to finish, so on a GPU part of the
+    # forward is counted here
+    copy_seconds = 0.0
+
+    def on_layer(layer: int, attention: torch.Tensor) -> None:
+        nonlocal copy_seconds
+        start = time.perf_counter()
+        copy_layer(layer, attention)
+        copy_seconds += time.perf_counter() - start
+
+    def copy_layer(layer: int, attention: torch.Tensor) -> None:
+        nonlocal host_buffer, n_head
+        n_head = attention.shape[1]
+        if reduce_on_device:
+            for idx, n_tokens in enumerate(lengths):
+                prompt_attention = attention[idx, :, :n_tokens, :n_tokens]
+                if summary:
+                    reduced = summarize_attention(
+                        prompt_attention, argmax=summary_argmax
+                    )
+                else:
+                    reduced = tuple(
+                        t.cpu()
+                        for t in sparsify_attention(
+                            prompt_attention, top_k=top_k, threshold=threshold
+                        )
+                    )
+                reduced_layers[idx].append(reduced)
+            return
+        if host_buffer is None:
+            host_buffer = torch.empty(
+                (len(prompts), mt.n_layer, *attention.shape[1:]), dtype=torch.float32
+            )
+        host_buffer[:, layer].copy_(attention)
+
+    start = time.perf_counter()
+    with capture_attention(mt, callback=on_layer):
+        output = mt.model(**inputs, output_attentions=True, use_cache=value_weighted)
+    STAGE_SECONDS.observe(time.perf_counter() - start - copy_seconds, stage="forward")
+    if value_weighted:
+        start = time.perf_counter()
+        for layer in range(mt.n_layer):
+            value_norms = output.past_key_values[layer][1].norm(dim=-1)
+            host_buffer[:, layer] *= value_norms.to(torch.float32).cpu()[:, :, None, :]
+        copy_seconds += time.perf_counter() - start
+    STAGE_SECONDS.observe(copy_seconds, stage="device_to_host")
+
+    attention_information = []
+    for idx, n_tokens in enumerate(lengths):
+        input_ids = inputs.input_ids[idx, :n_tokens]
+        tokenized_prompt = mt.decode_ids(input_ids)
+        if summary:
+            if reduce_on_device:
+                layer_stats = reduced_layers[idx]
+            else:
+                layer_stats = [
+                    summarize_attention(
+                        layer_attention[:, :n_tokens, :n_tokens], argmax=summary_argmax
+                    )
+                    for layer_attention in host_buffer[idx]
+                ]
+            attention_information.append(
+                AttentionHeadSummary(
+                    prompt=prompts[idx],
+                    tokenized_prompt=tokenized_prompt,
+                    **{
+                        key: torch.stack([stats[key] for stats in layer_stats])
+                        .cpu()
+                        .numpy()
+                        for key in layer_stats[0]
+                    },
+                )
+            )
+            continue
+        if sparse:
+            if reduce_on_device:
+                indptr, indices, values = concat_csr(reduced_layers[idx])
+            else:
+                indptr, indices, values = sparsify_attention(
+                    host_buffer[idx, :, :, :n_tokens, :n_tokens],
+                    top_k=top_k,
+                    threshold=threshold,
+                )
+            attention_information.append(
+                SparseAttentionInformation(
+                    prompt=prompts[idx],
+                    tokenized_prompt=tokenized_prompt,
+                    shape=[mt.n_layer, n_head, n_tokens, n_tokens],
+                    indptr=indptr.numpy(),
+                    indices=indices.to(torch.int32).numpy(),
+                    values=values.to(torch.float32).numpy(),
+                )
+            )
+            continue
+        attention_matrices = host_buffer[idx, :, :, :n_tokens, :n_tokens].numpy()
+        if len(prompts) > 1:
+            # a view would keep the whole batch buffer alive with every result, and
+            # caches bounded by `result_nbytes` would only count the view
+            attention_matrices = attention_matrices.copy()
+        attention_information.append(
+            AttentionInformation(
+                prompt=prompts[idx],
+                tokenized_prompt=tokenized_prompt,
+                attention_matrices=attention_matrices,
+            )
+        )
+    if isinstance(prompt, str):
+        return attention_information[0]
+    return attention_information
+
+
+@dataclass
+class PromptState:
+    """What `get_attention_matrices_incremental` keeps around to extend a prompt."""
+
+    input_ids: list[int]
+    # ((key, value), ...) or a `Cache`, each (1, heads, tokens, head_dim). None if
+    # only the attention rows were kept, the kv cache of the prefix is then recomputed
+    past_key_values: Optional[Any]
+    attention_information: AttentionInformation
+    value_weighted: bool
+
+
+def truncate_past_key_values(past_key_values, n_tokens: int):
+    """
+    Returns the first `n_tokens` positions of `past_key_values`, in the same format:
+    legacy ((key, value), ...) tuples stay tuples and HF `Cache` objects, which newer
+    transformers versions require for some models, come back as a `DynamicCache`.
+    Never modifies the input (a `Cache` would be extended in place by the next
+    forward).
+    """
+    legacy = tuple(
+        (
+            past_key_values[i][0][:, :, :n_tokens],
+            past_key_values[i][1][:, :, :n_tokens],
+        )
+        for i in range(len(past_key_values))
+    )
+    if isinstance(past_key_values, tuple):
+        return legacy
+    from transformers import DynamicCache
+
+    if hasattr(DynamicCache, "from_legacy_cache"):
+        return DynamicCache.from_legacy_cache(legacy)
+    cache = DynamicCache()
+    for layer, (key, value) in enumerate(legacy):
+        cache.update(key, value, layer)
+    return cache
+
+
+def shared_prefix_length(a: list[int], b: list[int]) -> int:
+    n_shared = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n_shared += 1
+    return n_shared
+
+
+def reusable_prefix_length(
+    previous: Optional[PromptState], input_ids: list[int], value_weighted: bool
+) -> int:
+    """Number of leading tokens of `input_ids` whose attention rows (and kv cache)
+    `get_attention_matrices_incremental` can take from `previous`."""
+    if previous is None or previous.value_weighted != value_weighted:
+        return 0
+    # at least one token has to go through the model to get a fresh cache
+    n_shared = shared_prefix_length(previous.input_ids, input_ids)
+    return min(n_shared, len(input_ids) - 1)
+
+
+@torch.inference_mode()
+def get_attention_matrices_incremental(
+    prompt: str,
+    mt: ModelandTokenizer,
+    previous: Optional[PromptState] = None,
+    value_weighted: bool = False,
+) -> tuple[AttentionInformation, PromptState]:
+    """
+    Same result as `get_attention_matrices`, but reuses the `past_key_values` and the
+    attention rows of a `previous` prompt for the longest shared token prefix. Only
+    the query rows of the new tokens are computed, so the cost scales with the size
+    of the edit rather than the length of the prompt. If `previous` has no kv cache,
+    the prefix is run once more without attention outputs to rebuild it.
+
     Returns:
-        attention matrices: torch.tensor of shape (layers, heads, tokens, tokens)
+        the AttentionInformation and the PromptState to pass as `previous` next time
     """
-    # ! doesn't support batching yet. not really needed in this project
     assert isinstance(prompt, str), "Prompt must be a string"
+    with STAGE_SECONDS.time(stage="tokenization"):
+        input_ids = mt.tokenizer(prompt).input_ids
+    n_tokens = len(input_ids)
+    n_shared = reusable_prefix_length(previous, input_ids, value_weighted)
+    logger.debug(f"reusing {n_shared}/{n_tokens} tokens of the previous prompt")
+
+    with STAGE_SECONDS.time(stage="forward"):
+        past_key_values = None
+        if n_shared > 0 and previous.past_key_values is not None:
+            past_key_values = truncate_past_key_values(
+                previous.past_key_values, n_shared
+            )
+        elif n_shared > 0:
+            output = mt.model(
+                input_ids=torch.tensor([input_ids[:n_shared]], device=mt.device),
+                use_cache=True,
+            )
+            past_key_values = truncate_past_key_values(
+                output.past_key_values, n_shared
+            )
+            TOKENS_PROCESSED.inc(n_shared)
+
+        output = mt.model(
+            input_ids=torch.tensor([input_ids[n_shared:]], device=mt.device),
+            attention_mask=torch.ones(1, n_tokens, dtype=torch.long, device=mt.device),
+            past_key_values=past_key_values,
+            use_cache=True,
+            output_attentions=True,
+        )
+        TOKENS_PROCESSED.inc(n_tokens - n_shared)
+        # (layers, heads, new, tokens)
+        new_rows = torch.stack(output.attentions, dim=1)[0]
+        if value_weighted:
+            values = torch.stack(
+                [output.past_key_values[i][1] for i in range(mt.n_layer)], dim=1
+            )[0]  # (layers, heads, tokens, head_dim)
+            new_rows = torch.einsum("abcd,abd->abcd", new_rows, values.norm(dim=-1))
+
+    with STAGE_SECONDS.time(stage="device_to_host"):
+        attention_matrices = np.zeros(
+            (*new_rows.shape[:2], n_tokens, n_tokens), dtype=np.float32
+        )
+        attention_matrices[:, :, n_shared:] = (
+            new_rows.detach().cpu().to(torch.float32).numpy()
+        )
+    tokenized_prompt = mt.decode_ids(input_ids[n_shared:])
+    if n_shared > 0:
+        previous_info = previous.attention_information
+        attention_matrices[:, :, :n_shared, :n_shared] = (
+            previous_info.attention_matrices[:, :, :n_shared, :n_shared]
+        )
+        tokenized_prompt = (
+            previous_info.tokenized_prompt[:n_shared] + tokenized_prompt
+        )
+
+    attention_information = AttentionInformation(
+        prompt=prompt,
+        tokenized_prompt=tokenized_prompt,
+        attention_matrices=attention_matrices,
+    )
+    state = PromptState(
+        input_ids=input_ids,
+        past_key_values=truncate_past_key_values(output.past_key_values, n_tokens),
+        attention_information=attention_information,
+        value_weighted=value_weighted,
+    )
+    return attention_information, state
+
+
+@torch.inference_mode()
+def get_attention_rows(
+    prompt: str,
+    mt: ModelandTokenizer,
+    rows: tuple[Optional[int], Optional[int]],
+    value_weighted: bool = False,
+    tile_size: int = 256,
+) -> AttentionInformation:
+    """
+    Computes only the attention rows of the target tokens in `rows`, for prompts too
+    long to materialize every layer's (tokens, tokens) attention. The tokens before
+    the range are run once to fill the kv cache, then the target tokens are run in
+    tiles of `tile_size` on top of the cached keys, each tile yielding its rows.
+    Memory scales with the number of rows requested.
+
+    Returns:
+        AttentionInformation with attention matrices of shape
+        (layers, heads, stop - start, tokens) and `rows=[start, stop]`. Entries of
+        source tokens after a target are zero, as in the full matrices.
+    """
+    assert tile_size > 0, "tile_size must be positive"
+    with STAGE_SECONDS.time(stage="tokenization"):
+        input_ids = mt.tokenizer(prompt, return_tensors="pt").input_ids.to(mt.device)
+    n_tokens = input_ids.shape[-1]
+    start, stop, _ = slice(*rows).indices(n_tokens)
+    if start >= stop:
+        raise ValueError(f"empty range of rows {rows} for {n_tokens} tokens")
+    # the tokens after the last target row are never run
+    TOKENS_PROCESSED.inc(stop)
+    forward_start = time.perf_counter()
+    copy_seconds = 0.0
+
+    past_key_values = None
+    if start > 0:
+        output = mt.model(input_ids[:, :start], use_cache=True)
+        past_key_values = truncate_past_key_values(output.past_key_values, start)
+
+    attention_rows: Optional[torch.Tensor] = None  # (layers, heads, rows, tokens)
+    for tile_start in range(start, stop, tile_size):
+        tile_stop = min(tile_start + tile_size, stop)
+
+        def on_layer(layer: int, attention: torch.Tensor) -> None:
+            nonlocal copy_seconds
+            start_copy = time.perf_counter()
+            copy_rows(layer, attention)
+            copy_seconds += time.perf_counter() - start_copy
+
+        def copy_rows(layer: int, attention: torch.Tensor) -> None:
+            nonlocal attention_rows
+            if attention_rows is None:
+                attention_rows = torch.zeros(
+                    (mt.n_layer, attention.shape[1], stop - start, n_tokens),
+                    dtype=torch.float32,
+                )
+            attention_rows[
+                layer, :, tile_start - start : tile_stop - start, :tile_stop
+            ].copy_(attention[0])
+
+        with capture_attention(mt, callback=on_layer):
+            output = mt.model(
+                input_ids[:, tile_start:tile_stop],
+                attention_mask=torch.ones(
+                    1, tile_stop, dtype=torch.long, device=mt.device
+                ),
+                past_key_values=past_key_values,
+                use_cache=True,
+                output_attentions=True,
+            )
+        past_key_values = truncate_past_key_values(output.past_key_values, tile_stop)
+    STAGE_SECONDS.observe(
+        time.perf_counter() - forward_start - copy_seconds, stage="forward"
+    )
 
-    inputs = mt.tokenizer(prompt, return_tensors="pt").to(mt.device)
-    output = mt.model(
-        **inputs, output_attentions=True
-    )  # batch_size x n_tokens x vocab_size, only want last token prediction
-    attentions = torch.vstack(output.attentions)  # (layers, heads, tokens, tokens)
     if value_weighted:
-        values = torch.vstack(
-            [output.past_key_values[i][1] for i in range(mt.n_layer)]
-        )  # (layers, heads, tokens, head_dim)
-        attentions = torch.einsum("abcd,abd->abcd", attentions, values.norm(dim=-1))
+        start_copy = time.perf_counter()
+        for layer in range(mt.n_layer):
+            value_norms = past_key_values[layer][1][0].norm(dim=-1)  # (heads, stop)
+            attention_rows[layer, :, :, :stop] *= (
+                value_norms.to(torch.float32).cpu()[:, None, :]
+            )
+        copy_seconds += time.perf_counter() - start_copy
+    STAGE_SECONDS.observe(copy_seconds, stage="device_to_host")
+
     return AttentionInformation(
         prompt=prompt,
-        tokenized_prompt=[mt.tokenizer.decode(tok) for tok in inputs.input_ids[0]],
-        attention_matrices=attentions.detach().cpu().to(torch.float32).numpy(),
+        tokenized_prompt=mt.decode_ids(input_ids[0]),
+        attention_matrices=attention_rows.numpy(),
+        rows=[start, stop],
     )
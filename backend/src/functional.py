@@ -1,18 +1,25 @@
+from __future__ import annotations
+
 import copy
+import inspect
 import logging
 import random
 import re
-from typing import Any, Callable, Literal, Optional, Union
+from typing import TYPE_CHECKING, Any, Callable, Literal, Optional, Union
 
-import baukit
 import numpy as np
 import src.utils.tokenizer_utils as tokenizer_utils
 import torch
 from src.models import ModelandTokenizer
-from src.utils.dataclasses import PredictedToken
+from src.utils.dataclasses import PredictedToken, PredictedTokenArrays
+from src.utils.tokenizer_utils import find_token_range  # noqa: F401, re-exported
+
+# transformers and baukit are slow to import and only needed once a model is used,
+# see `python -m src.utils.import_utils src.functional`
+if TYPE_CHECKING:
+    from transformers import AutoTokenizer
 
 # from mamba_ssm.models.mixer_seq_simple import MambaLMHeadModel as MambaLMHeadModel
-from transformers import AutoTokenizer
 
 logger = logging.getLogger(__name__)
 
@@ -35,105 +42,13 @@ def make_inputs(tokenizer, prompts, device="cuda"):
 
 
 def decode_tokens(tokenizer, token_array):
+    if isinstance(tokenizer, ModelandTokenizer):
+        return tokenizer.decode_ids(token_array)
     if hasattr(token_array, "shape") and len(token_array.shape) > 1:
         return [decode_tokens(tokenizer, row) for row in token_array]
     return [tokenizer.decode([t]) for t in token_array]
 
 
-import transformers
-
-
-def find_token_range(
-    string: str,
-    substring: str,
-    tokenizer: Optional[transformers.AutoTokenizer] = None,
-    occurrence: int = 0,
-    offset_mapping: Optional[torch.Tensor] = None,
-    **kwargs: Any,
-) -> tuple[int, int]:
-    """Find index range of tokenized string containing tokens for substring.
-
-    The kwargs are forwarded to the tokenizer.
-
-    A simple example:
-
-        string = 'The batman is the night.'
-        substring = 'batman'
-        tokenizer = ...
-
-        # Example tokenization: ['the', 'bat', '##man', 'is', 'the', 'night']
-        assert find_token_range(string, substring, tokenizer) == (1, 3)
-
-    Args:
-        string: The string.
-        substring: The substring to find token range for.
-        tokenizer: The tokenizer. If not set, offset_mapping must be.
-        occurrence: The occurence of the substring to look for.
-            Zero indexed. Defaults to 0, the first occurrence.
-        offset_mapping: Precomputed offset mapping. If not set, tokenizer will be run.
-
-    Raises:
-        ValueError: If substring is not actually in string or if banned
-            kwargs are specified.
-
-    Returns:
-        Tuple[int, int]: The start (inclusive) and end (exclusive) token idx.
-    """
-    if tokenizer is None and offset_mapping is None:
-        raise ValueError("must set either tokenizer= or offset_mapping=")
-    if "return_offsets_mapping" in kwargs:
-        raise ValueError("cannot set return_offsets_mapping")
-    if substring not in string:
-        raise ValueError(f'"{substring}" not found in "{string}"')
-    if occurrence < 0:
-        # If occurrence is negative, count from the right.
-        char_start = string.rindex(substring)
-        for _ in range(-1 - occurrence):
-            try:
-                char_start = string.rindex(substring, 0, char_start)
-            except ValueError as error:
-                raise ValueError(
-                    f"could not find {-occurrence} occurrences "
-                    f'of "{substring} in "{string}"'
-                ) from error
-    else:
-        char_start = string.index(substring)
-        for _ in range(occurrence):
-            try:
-                char_start = string.index(substring, char_start + 1)
-            except ValueError as error:
-                raise ValueError(
-                    f"could not find {occurrence + 1} occurrences "
-                    f'of "{substring} in "{string}"'
-                ) from error
-    char_end = char_start + len(substring)
-
-    # print(char_start, char_end)
-
-    if offset_mapping is None:
-        assert tokenizer is not None
-        tokens = tokenizer(string, return_offsets_mapping=True, **kwargs)
-        offset_mapping = tokens.offset_mapping
-
-    token_start, token_end = None, None
-    for index, (token_char_start, token_char_end) in enumerate(offset_mapping):
-        # Skip special tokens # ! Is this the proper way to do this?
-        if token_char_start == token_char_end:
-            continue
-        if token_start is None:
-            if token_char_start <= char_start and token_char_end >= char_start:
-                token_start = index
-        if token_end is None:
-            if token_char_start <= char_end and token_char_end >= char_end:
-                token_end = index
-                break
-
-    assert token_start is not None
-    assert token_end is not None
-    assert token_start <= token_end
-    return (token_start, token_end + 1)
-
-
 def guess_subject(prompt):
     return re.search(r"(?!Wh(o|at|ere|en|ich|y) )([A-Z]\S*)(\s[A-Z][a-z']*)*", prompt)[
         0
@@ -147,8 +62,6 @@ def untuple(object: Any):
 
 
 ######################### utils #########################
-from src.models import unwrap_tokenizer
-
 
 @torch.inference_mode()
 def interpret_logits(
@@ -157,11 +70,15 @@ def interpret_logits(
     k: int = 10,
     get_proba: bool = False,
 ) -> list[tuple[str, float]]:
-    tokenizer = unwrap_tokenizer(tokenizer)
     logits = torch.nn.functional.softmax(logits, dim=-1) if get_proba else logits
-    token_ids = logits.topk(dim=-1, k=k).indices.squeeze().tolist()
-    logit_values = logits.topk(dim=-1, k=k).values.squeeze().tolist()
-    return [(tokenizer.decode(t), round(v, 3)) for t, v in zip(token_ids, logit_values)]
+    topk = logits.topk(dim=-1, k=k)
+    token_ids = topk.indices.squeeze().tolist()
+    logit_values = topk.values.squeeze().tolist()
+    if isinstance(tokenizer, ModelandTokenizer):
+        tokens = tokenizer.decode_ids(token_ids)
+    else:
+        tokens = [tokenizer.decode(t) for t in token_ids]
+    return [(token, round(v, 3)) for token, v in zip(tokens, logit_values)]
 
 
 @torch.inference_mode()
@@ -179,11 +96,94 @@ def logit_lens(
     logits = torch.nn.functional.softmax(logits, dim=-1) if get_proba else logits
     candidates = interpret_logits(mt, logits, k=k)
     interested_logits = {
-        t: (logits[t].item(), mt.tokenizer.decode(t)) for t in interested_tokens
+        t: (value, token)
+        for t, value, token in zip(
+            interested_tokens,
+            logits[interested_tokens].tolist(),
+            mt.decode_ids(interested_tokens),
+        )
     }
     return candidates, interested_logits
 
 
+def make_length_batches(
+    lengths: list[int],
+    max_batch_size: int,
+    max_batch_tokens: Optional[int] = None,
+) -> list[list[int]]:
+    """
+    Groups the indices of prompts of similar length into batches, longest prompts
+    first, so little of each batch is padding. A batch holds at most
+    `max_batch_size` prompts and, if set, at most `max_batch_tokens` tokens once
+    padded (a single prompt longer than that gets a batch of its own).
+    """
+    assert max_batch_size > 0, "max_batch_size must be positive"
+    order = sorted(range(len(lengths)), key=lambda idx: -lengths[idx])
+    batches: list[list[int]] = []
+    batch: list[int] = []
+    for idx in order:
+        # the first prompt of a batch is its longest, the others are padded to it
+        padded_tokens = (len(batch) + 1) * lengths[batch[0] if batch else idx]
+        if batch and (
+            len(batch) >= max_batch_size
+            or (max_batch_tokens is not None and padded_tokens > max_batch_tokens)
+        ):
+            batches.append(batch)
+            batch = []
+        batch.append(idx)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def make_left_padded_inputs(
+    mt: ModelandTokenizer, input_ids: list[list[int]]
+) -> dict[str, torch.Tensor]:
+    """Left pads the token ids into a batch for `mt.model`, with the attention mask
+    and position ids if the model's forward takes them (Mamba takes neither)."""
+    with tokenizer_utils.set_padding_side(mt.tokenizer, padding_side="left"):
+        inputs = mt.tokenizer.pad({"input_ids": input_ids}, return_tensors="pt").to(
+            mt.device
+        )
+    forward_parameters = inspect.signature(mt.model.forward).parameters
+    batch_inputs = {"input_ids": inputs.input_ids}
+    if "attention_mask" in forward_parameters:
+        batch_inputs["attention_mask"] = inputs.attention_mask
+    if "position_ids" in forward_parameters:
+        # left padding shifts the real tokens, count positions from the first one
+        position_ids = inputs.attention_mask.cumsum(dim=-1) - 1
+        batch_inputs["position_ids"] = position_ids.clamp(min=0)
+    return batch_inputs
+
+
+def get_token_ids(mt: ModelandTokenizer, tokens: list[Union[str, int]]) -> list[int]:
+    """The id of every token. Strings are tokenized in one call and their first
+    token (after the BOS token for llama) is used, ints are taken as ids."""
+    strings = [token for token in tokens if isinstance(token, str)]
+    _t_idx = 0 if "llama" not in mt.name.lower() else 1
+    encoded = iter(mt.tokenizer(strings).input_ids if len(strings) > 0 else [])
+    return [
+        next(encoded)[_t_idx] if isinstance(token, str) else int(token)
+        for token in tokens
+    ]
+
+
+def get_token_ranks(
+    scores: torch.Tensor, token_ids: torch.Tensor
+) -> tuple[torch.Tensor, torch.Tensor]:
+    """
+    Rank (1 = highest) and score of one token per row of `scores` (batch, vocab),
+    e.g. probabilities or logits. The rank is the number of tokens scored higher
+    plus one, counted for the whole batch at once instead of sorting the vocabulary.
+
+    Returns:
+        ranks (batch,) and scores (batch,) of the tokens, on the device of `scores`
+    """
+    token_scores = scores.gather(dim=-1, index=token_ids[:, None])
+    ranks = (scores > token_scores).sum(dim=-1) + 1
+    return ranks, token_scores.squeeze(-1)
+
+
 @torch.inference_mode()
 def predict_next_token(
     mt: ModelandTokenizer,
@@ -191,14 +191,26 @@ def predict_next_token(
     k: int = 5,
     batch_size: int = 8,
     token_of_interest: Optional[Union[Union[str, int], list[Union[str, int]]]] = None,
+    max_batch_tokens: Optional[int] = None,
+    return_arrays: bool = False,
 ) -> Union[
     list[list[PredictedToken]],
     tuple[list[list[PredictedToken]], list[tuple[int, PredictedToken]]],
+    PredictedTokenArrays,
+    tuple[PredictedTokenArrays, PredictedTokenArrays],
 ]:
     # ! Do not use batch decoding for LLaMA-2 models. Not working properly.
     # * Seems to be working properly for Mamba-S4. Consider batching for speed.
     # ? What the hack is happening with the subject `{Big Ben} is located in the city of`
-    """Compute the next token."""
+    """Compute the next token.
+
+    Prompts are batched by length (see `make_length_batches`), up to `batch_size`
+    prompts and `max_batch_tokens` padded tokens per batch, and the predictions
+    are returned in the order of `prompt`. The results stay on the device until
+    all batches are done and are then copied to the host in one go. With
+    `return_arrays`, they are returned as `PredictedTokenArrays` instead of being
+    decoded into `PredictedToken`s.
+    """
     if isinstance(prompt, str):
         prompt = [prompt]
         if token_of_interest is not None:
@@ -206,69 +218,76 @@ def predict_next_token(
 
     if token_of_interest is not None:
         assert len(token_of_interest) == len(prompt)
-        track_interesting_tokens = []
-
-    with tokenizer_utils.set_padding_side(mt.tokenizer, padding_side="left"):
-        inputs = mt.tokenizer(prompt, return_tensors="pt", padding="longest").to(
-            mt.device
+        interest_ids = torch.tensor(
+            get_token_ids(mt, token_of_interest), device=mt.device
+        )
+        interest_ranks = torch.zeros(len(prompt), dtype=torch.long, device=mt.device)
+        interest_probs = torch.zeros(len(prompt), device=mt.device)
+
+    input_ids = mt.tokenizer(prompt).input_ids
+
+    topk_ids = torch.zeros((len(prompt), k), dtype=torch.long, device=mt.device)
+    topk_probs = torch.zeros((len(prompt), k), device=mt.device)
+    for batch in make_length_batches(
+        [len(ids) for ids in input_ids],
+        max_batch_size=batch_size,
+        max_batch_tokens=max_batch_tokens,
+    ):
+        batch_inputs = make_left_padded_inputs(mt, [input_ids[idx] for idx in batch])
+
+        batch_outputs = mt.model(**batch_inputs)
+        logits = (
+            batch_outputs.logits[:, -1]
+            if hasattr(batch_outputs, "logits")
+            else batch_outputs[:, -1]
         )
+        next_token_probs = logits.float().softmax(dim=-1)
+        next_token_topk = next_token_probs.topk(dim=-1, k=k)
 
-    with torch.inference_mode():
-        predictions = []
-        for i in range(0, len(inputs.input_ids), batch_size):
-            batch_inputs = {
-                "input_ids": inputs.input_ids[i : i + batch_size],
-            }
-
-            batch_outputs = mt.model(**batch_inputs)
-            logits = (
-                batch_outputs.logits[:, -1]
-                if hasattr(batch_outputs, "logits")
-                else batch_outputs[:, -1]
+        batch_idx = torch.tensor(batch, device=mt.device)
+        topk_ids[batch_idx] = next_token_topk.indices
+        topk_probs[batch_idx] = next_token_topk.values
+        if token_of_interest is not None:
+            ranks, probs = get_token_ranks(next_token_probs, interest_ids[batch_idx])
+            interest_ranks[batch_idx] = ranks
+            interest_probs[batch_idx] = probs
+    topk_ids, topk_probs = topk_ids.cpu(), topk_probs.cpu()
+    if token_of_interest is not None:
+        interest_ids = interest_ids.cpu()
+        interest_ranks, interest_probs = interest_ranks.cpu(), interest_probs.cpu()
+
+    if return_arrays:
+        predictions = PredictedTokenArrays(
+            token_ids=topk_ids.numpy(), probs=topk_probs.numpy()
+        )
+        if token_of_interest is not None:
+            return predictions, PredictedTokenArrays(
+                token_ids=interest_ids.numpy(),
+                probs=interest_probs.numpy(),
+                ranks=interest_ranks.numpy(),
             )
-            next_token_probs = logits.float().softmax(dim=-1)
-            next_token_topk = next_token_probs.topk(dim=-1, k=k)
-
-            for token_ids, token_probs in zip(
-                next_token_topk.indices, next_token_topk.values
-            ):
-                predictions.append(
-                    [
-                        PredictedToken(
-                            token=mt.tokenizer.decode(token_id),
-                            # token_id=token_id.item(),
-                            prob=prob.item(),
-                        )
-                        for token_id, prob in zip(token_ids, token_probs)
-                    ]
-                )
-            if token_of_interest is not None:
-                # print(batch_inputs["input_ids"].shape[0])
-                for j in range(i, i + batch_inputs["input_ids"].shape[0]):
-                    _t_idx = 0 if "llama" not in mt.name.lower() else 1
-                    tok_id = (
-                        mt.tokenizer(token_of_interest[j]).input_ids[_t_idx]
-                        if type(token_of_interest[j]) == str
-                        else token_of_interest[j]
-                    )
-                    # print(tok_id)
-                    probs = next_token_probs[j - i]
-                    order = probs.topk(dim=-1, k=probs.shape[-1]).indices.squeeze()
-                    prob_tok = probs[tok_id]
-                    rank = int(torch.where(order == tok_id)[0].item() + 1)
-                    track_interesting_tokens.append(
-                        (
-                            rank,
-                            PredictedToken(
-                                token=mt.tokenizer.decode(tok_id),
-                                # token_id=tok_id.item()
-                                # if isinstance(tok_id, torch.Tensor)
-                                # else tok_id,
-                                prob=prob_tok.item(),
-                            ),
-                        )
-                    )
+        return predictions
+
+    predictions = [
+        [
+            PredictedToken(
+                token=token,
+                # token_id=token_id.item(),
+                prob=prob,
+            )
+            for token, prob in zip(tokens, token_probs)
+        ]
+        for tokens, token_probs in zip(mt.decode_ids(topk_ids), topk_probs.tolist())
+    ]
     if token_of_interest is not None:
+        track_interesting_tokens = [
+            (rank, PredictedToken(token=token, prob=prob))
+            for rank, token, prob in zip(
+                interest_ranks.tolist(),
+                mt.decode_ids(interest_ids),
+                interest_probs.tolist(),
+            )
+        ]
         return predictions, track_interesting_tokens
     return predictions
 
@@ -385,9 +404,11 @@ def get_h(
 
     subj_last_idx = subject_end - 1
     logger.debug(
-        f"h_index={subj_last_idx} | h_token={mt.tokenizer.decode(tokenized['input_ids'][0][subj_last_idx])}"
+        f"h_index={subj_last_idx} | h_token={mt.decode_ids(tokenized['input_ids'][0][subj_last_idx])}"
     )
 
+    import baukit
+
     retain_input = mode == "input"
     with baukit.TraceDict(
         module=mt.model, layers=layers, retain_input=retain_input
@@ -405,8 +426,78 @@ def get_h(
     return h
 
 
+@torch.inference_mode()
+def get_h_batched(
+    mt: ModelandTokenizer,
+    prompts: list[str],
+    subjects: list[str],
+    layers: list[str],
+    mode: Literal["input", "output"] = "output",
+    batch_size: int = 32,
+    max_batch_tokens: Optional[int] = None,
+) -> torch.Tensor:
+    """
+    Batched `get_h`: the hidden states at the last token of `subjects[i]` in
+    `prompts[i]`, for every prompt. Prompts are batched by length (see
+    `make_length_batches`) and left padded, and each batch is one traced forward.
+
+    Returns:
+        tensor of shape (len(prompts), len(layers), hidden size) on the CPU, in the
+        order of `prompts`
+    """
+    assert len(prompts) > 0, "need at least one prompt"
+    assert len(prompts) == len(subjects), "need one subject per prompt"
+    tokenized = mt.tokenizer(prompts, return_offsets_mapping=True)
+    subject_last = [
+        find_token_range(prompt, subject, offset_mapping=offset_mapping)[1] - 1
+        for prompt, subject, offset_mapping in zip(
+            prompts, subjects, tokenized.offset_mapping
+        )
+    ]
+    input_ids = tokenized.input_ids
+
+    import baukit
+
+    h = None
+    retain_input = mode == "input"
+    for batch in make_length_batches(
+        [len(ids) for ids in input_ids],
+        max_batch_size=batch_size,
+        max_batch_tokens=max_batch_tokens,
+    ):
+        batch_inputs = make_left_padded_inputs(mt, [input_ids[idx] for idx in batch])
+
+        # left padding shifts every prompt right by its amount of padding
+        n_padded = batch_inputs["input_ids"].shape[1]
+        token_idx = torch.tensor(
+            [n_padded - len(input_ids[idx]) + subject_last[idx] for idx in batch],
+            device=mt.device,
+        )
+        rows = torch.arange(len(batch), device=mt.device)
+
+        with baukit.TraceDict(
+            module=mt.model, layers=layers, retain_input=retain_input
+        ) as traces:
+            mt.model(**batch_inputs)
+        batch_h = torch.stack(
+            [
+                untuple(
+                    traces[layer].output if mode == "output" else traces[layer].input
+                )[rows, token_idx]
+                for layer in layers
+            ],
+            dim=1,
+        )  # (batch, layers, hidden size)
+
+        if h is None:
+            h = torch.empty((len(prompts), *batch_h.shape[1:]), dtype=batch_h.dtype)
+        h[torch.tensor(batch)] = batch_h.cpu()
+    return h
+
+
 def detensorize_objects(obj):
-    obj_clone = copy.deepcopy(obj)
+    # a shallow copy is enough, the tensor fields are replaced and never mutated
+    obj_clone = copy.copy(obj)
     for key, value in obj_clone.__dict__.items():
         if isinstance(value, torch.Tensor) or isinstance(value, np.ndarray):
             setattr(obj_clone, key, value.tolist())
@@ -0,0 +1,146 @@
+import logging
+import queue
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Callable, Iterator, Optional
+
+import numpy as np
+import torch
+from src.models import ModelandTokenizer
+from src.utils.metrics import STAGE_SECONDS, TOKENS_PROCESSED
+
+logger = logging.getLogger(__name__)
+
+
+def attention_module_names(mt: ModelandTokenizer) -> list[str]:
+    assert (
+        mt.attn_module_name_format is not None
+    ), f"attention modules of {mt.name} are not known"
+    return [mt.attn_module_name_format.format(i) for i in range(mt.n_layer)]
+
+
+def find_attention_weights(output) -> Optional[int]:
+    """
+    Position of the attention weights (batch, heads, queries, keys) in the output
+    tuple of a HF attention module. The position differs between architectures and
+    transformers versions, but it is always the first 4-d tensor after the
+    attention output itself. Returns None if the module did not output them.
+    """
+    if not isinstance(output, tuple):
+        return None
+    for idx, value in enumerate(output[1:], start=1):
+        if isinstance(value, torch.Tensor) and value.ndim == 4:
+            return idx
+    return None
+
+
+@contextmanager
+def capture_attention(
+    mt: ModelandTokenizer,
+    callback: Callable[[int, torch.Tensor], None],
+    drop: bool = True,
+) -> Iterator[None]:
+    """
+    Calls `callback(layer, attention_weights)` as soon as each attention module
+    finishes. The model has to be run with `output_attentions=True`.
+
+    If `drop` is set, the weights are removed from the module output after the
+    callback, so the model does not keep every layer's attention alive until the end
+    of the forward (`output.attentions` will be a tuple of Nones).
+    """
+
+    def make_hook(layer: int) -> Callable:
+        def hook(module, inputs, output):
+            idx = find_attention_weights(output)
+            if idx is None:
+                raise RuntimeError(
+                    f"no attention weights in the output of layer {layer}, "
+                    "was the model called with `output_attentions=True`?"
+                )
+            callback(layer, output[idx])
+            if drop:
+                return output[:idx] + (None,) + output[idx + 1 :]
+
+        return hook
+
+    import baukit
+
+    handles = [
+        baukit.get_module(mt.model, name).register_forward_hook(make_hook(layer))
+        for layer, name in enumerate(attention_module_names(mt))
+    ]
+    try:
+        yield
+    finally:
+        for handle in handles:
+            handle.remove()
+
+
+def stream_attention_matrices(
+    prompt: str,
+    mt: ModelandTokenizer,
+    lock: Optional[threading.Lock] = None,
+) -> tuple[list[str], Iterator[tuple[int, np.ndarray]]]:
+    """
+    Runs the forward in a background thread and yields `(layer, attention)` with
+    attention of shape (heads, tokens, tokens) as soon as each layer's attention
+    module has finished, so that consumers can start on layer 0 while the deeper
+    layers are still computing.
+
+    Parameters:
+        prompt: str, input prompt
+        mt: ModelandTokenizer, model and tokenizer
+        lock: if given, held by the background thread for the whole forward
+    Returns:
+        the tokenized prompt, and the iterator over the layers. The forward starts
+        when the iteration does.
+    """
+    with STAGE_SECONDS.time(stage="tokenization"):
+        inputs = mt.tokenizer(prompt, return_tensors="pt").to(mt.device)
+    if "token_type_ids" in inputs:
+        inputs.pop("token_type_ids")
+    tokenized_prompt = mt.decode_ids(inputs.input_ids[0])
+
+    done = object()
+    layers: queue.Queue = queue.Queue()
+    copy_seconds = 0.0
+
+    def on_layer(layer: int, attention: torch.Tensor) -> None:
+        nonlocal copy_seconds
+        start = time.perf_counter()
+        layers.put((layer, attention[0].detach().cpu().to(torch.float32).numpy()))
+        copy_seconds += time.perf_counter() - start
+
+    @torch.inference_mode()
+    def forward() -> None:
+        try:
+            waiting = time.perf_counter()
+            with lock if lock is not None else nullcontext():
+                start = time.perf_counter()
+                STAGE_SECONDS.observe(start - waiting, stage="queue_wait")
+                with capture_attention(mt, callback=on_layer):
+                    mt.model(**inputs, output_attentions=True, use_cache=False)
+                TOKENS_PROCESSED.inc(inputs.input_ids.shape[-1])
+                STAGE_SECONDS.observe(
+                    time.perf_counter() - start - copy_seconds, stage="forward"
+                )
+                STAGE_SECONDS.observe(copy_seconds, stage="device_to_host")
+        except Exception as error:
+            logger.exception("streaming forward failed")
+            layers.put(error)
+        finally:
+            layers.put(done)
+
+    def iterate() -> Iterator[tuple[int, np.ndarray]]:
+        thread = threading.Thread(target=forward, name="attention-stream", daemon=True)
+        thread.start()
+        while True:
+            item = layers.get()
+            if item is done:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    return tokenized_prompt, iterate()
@@ -1,13 +1,20 @@
+from __future__ import annotations
+
 import logging
 import re
-from typing import Any, Callable, Literal, Optional, overload
+from typing import TYPE_CHECKING, Any, Callable, Literal, Optional, Sequence, overload
 
-import baukit
 import torch
-import transformers
 
 # from mamba_ssm.ops.triton.layernorm import rms_norm_fn
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from src.utils.timing import PhaseTimer
+
+# transformers and baukit are imported where they are used, so that importing this
+# module (and everything that imports it) does not pay for them
+if TYPE_CHECKING:
+    import transformers
+    from src.utils.typing import Model
+    from transformers import AutoTokenizer
 
 logger = logging.getLogger(__name__)
 
@@ -25,23 +32,32 @@ class ModelandTokenizer:
         assert (
             model is not None or model_path is not None
         ), "Either model or model_name must be provided"
+        # time spent in each phase of loading the model, see `warmup`
+        self.timings = PhaseTimer()
         if model is not None:
             assert tokenizer is not None, "Tokenizer must be provided with the model"
             self.name = model.config._name_or_path
         else:
+            from transformers import AutoModelForCausalLM, AutoTokenizer
+
             device = "cuda" if torch.cuda.is_available() else "cpu"
-            model, tokenizer = (
-                AutoModelForCausalLM.from_pretrained(
-                    model_path,
-                    # low_cpu_mem_usage=True,
-                    torch_dtype=torch_dtype,
-                ).to(device),
-                AutoTokenizer.from_pretrained(
+            with self.timings.phase("tokenizer"):
+                tokenizer = AutoTokenizer.from_pretrained(
                     model_path,
                     # padding_side='left'
-                ),
-            )
+                )
             tokenizer.pad_token = tokenizer.eos_token
+            with self.timings.phase("weights"):
+                model = AutoModelForCausalLM.from_pretrained(
+                    model_path,
+                    torch_dtype=torch_dtype,
+                    **low_memory_loading_kwargs(device),
+                )
+            with self.timings.phase("device move"):
+                if determine_device(model) != torch.device(device):
+                    model = model.to(device)
+                if device == "cuda":
+                    torch.cuda.synchronize()
             model.eval()
             print(
                 f"loaded model <{model_path}> | size: {get_model_size(model) :.3f} MB | dtype: {torch_dtype} | device: {device}"
@@ -55,6 +71,52 @@ class ModelandTokenizer:
 
         self.parse_config(model.config)
         self.cache_forwards()
+        with self.timings.phase("vocabulary"):
+            # every id decoded on its own, like `tokenizer.decode(id)` would
+            self.vocabulary: list[str] = self.tokenizer.batch_decode(
+                [[token_id] for token_id in range(len(self.tokenizer))]
+            )
+
+    def decode_ids(self, ids: Any) -> str | list:
+        """
+        Decodes every token id separately through the `vocabulary` table. `ids` is
+        a single id, or a (nested) list, array or tensor of ids, and the strings
+        come back in the same nesting.
+        """
+        if hasattr(ids, "tolist"):
+            ids = ids.tolist()  # one transfer instead of one per id
+        if isinstance(ids, list):
+            return [self.decode_ids(token_id) for token_id in ids]
+        if 0 <= ids < len(self.vocabulary):
+            return self.vocabulary[ids]
+        return self.tokenizer.decode(ids)  # padded embedding rows past the vocabulary
+
+    @property
+    def max_positions(self) -> Optional[int]:
+        """Longest input the model has position embeddings for, None if unbounded
+        (e.g. Mamba)."""
+        max_length = getattr(self.model.config, "max_position_embeddings", None)
+        return getattr(self.model.config, "n_positions", max_length)
+
+    @torch.inference_mode()
+    def warmup(self, prompt_lengths: Sequence[int] = (16, 128)) -> None:
+        """
+        Runs a forward (with attention outputs, like the attention endpoints do) for
+        each prompt length, so that the first requests do not pay for lazy kernel
+        initialization and allocator growth. Logs the time of every loading phase.
+        """
+        max_length = self.max_positions
+        with self.timings.phase("warmup"):
+            for length in prompt_lengths:
+                if max_length is not None:
+                    length = min(length, max_length)
+                input_ids = torch.randint(
+                    self.model.config.vocab_size, (1, length), device=self.device
+                )
+                self.model(input_ids=input_ids, output_attentions=True, use_cache=False)
+            if self.device.type == "cuda":
+                torch.cuda.synchronize()
+        logger.info(f"model <{self.name}> ready | {self.timings.report()}")
 
     def parse_config(self, model_config=None) -> None:
         fields = {
@@ -76,7 +138,18 @@ class ModelandTokenizer:
             fields["attn_module_name_format"] = "model.layers.{}.self_attn"
             fields["embedder_name"] = "model.embed_tokens"
             fields["final_layer_norm_name"] = "model.norm"
-            fields["lm_head_name"] = "model.lm_head"
+            fields["lm_head_name"] = "lm_head"
+
+        elif getattr(model_config, "model_type", None) == "gpt_neox":
+            # pythia and other GPTNeoXForCausalLM models
+            fields["n_layer"] = model_config.num_hidden_layers
+            fields["n_embd"] = model_config.hidden_size
+            fields["layer_name_format"] = "gpt_neox.layers.{}"
+            fields["mlp_module_name_format"] = "gpt_neox.layers.{}.mlp"
+            fields["attn_module_name_format"] = "gpt_neox.layers.{}.attention"
+            fields["embedder_name"] = "gpt_neox.embed_in"
+            fields["final_layer_norm_name"] = "gpt_neox.final_layer_norm"
+            fields["lm_head_name"] = "embed_out"
 
         elif is_gpt_variant(self.model):
             fields["n_layer"] = model_config.n_layer
@@ -86,7 +159,7 @@ class ModelandTokenizer:
             fields["attn_module_name_format"] = "transformer.h.{}.attn"
             fields["embedder_name"] = "transformer.wte"
             fields["final_layer_norm_name"] = "transformer.ln_f"
-            fields["lm_head_name"] = "transformer.lm_head"
+            fields["lm_head_name"] = "lm_head"
 
         if fields["layer_name_format"] is not None and fields["n_layer"] is not None:
             fields["layer_names"] = [
@@ -100,6 +173,8 @@ class ModelandTokenizer:
 
     @property
     def lm_head(self) -> torch.nn.Sequential:
+        import baukit
+
         lm_head = baukit.get_module(self.model, self.lm_head_name)
         ln_f = baukit.get_module(self.model, self.final_layer_norm_name)
         # ln_f = FinalLayerNorm(ln_f, mamba=isinstance(self.model, Mamba))
@@ -124,6 +199,21 @@ class ModelandTokenizer:
                 module.forward = self._module_forwards[name]
 
 
+def low_memory_loading_kwargs(device: str) -> dict[str, Any]:
+    """
+    Arguments for `from_pretrained` that load the weights straight into their final
+    dtype and device, without first materializing a randomly initialized copy of the
+    model on the CPU. Safetensors checkpoints are memory-mapped either way. Needs the
+    optional `accelerate` package, without it the model is loaded the default way.
+    """
+    try:
+        import accelerate  # noqa: F401
+    except ImportError:
+        logger.warning("`pip install accelerate` for faster, low-memory loading")
+        return {}
+    return {"low_cpu_mem_usage": True, "device_map": device}
+
+
 class LMHead(torch.nn.Module):
     def __init__(self, final_layer_norm: torch.nn.Module, lm_head: torch.nn.Module):
         super().__init__()
@@ -177,9 +267,6 @@ def untuple(object: Any):
     return object
 
 
-from src.utils.typing import Model, Tokenizer
-
-
 def maybe_prefix_eos(tokenizer, prompt: str) -> str:
     """Prefix prompt with EOS token if model has no special start token."""
     tokenizer = unwrap_tokenizer(tokenizer)
@@ -209,6 +296,8 @@ def is_gpt_variant(mt: Model | ModelandTokenizer) -> bool:
     # so we need to check for them separately
     if is_pythia_variant(mt):
         return False
+    import transformers
+
     return isinstance(
         mt,
         transformers.GPT2LMHeadModel
@@ -224,6 +313,8 @@ def is_llama_variant(mt: Model | ModelandTokenizer) -> bool:
     """Determine if model/tokenizer is GPT variant."""
     if isinstance(mt, ModelandTokenizer):
         mt = unwrap_model(mt)
+    import transformers
+
     if isinstance(mt, transformers.LlamaForCausalLM):
         return True
     if hasattr(mt, "config"):
@@ -242,6 +333,8 @@ def any_parameter(model: ModelandTokenizer | Model) -> torch.nn.Parameter | None
 
 def determine_embedding_layer_path(model: ModelandTokenizer | Model) -> str:
     model = unwrap_model(model)
+    import transformers
+
     if is_gpt_variant(model):
         return "transformer.wte"
     elif isinstance(model, transformers.LlamaForCausalLM):
@@ -254,6 +347,8 @@ def determine_embedding_layer_path(model: ModelandTokenizer | Model) -> str:
 
 def determine_final_layer_norm_path(model: ModelandTokenizer | Model) -> str:
     model = unwrap_model(model)
+    import transformers
+
     if is_gpt_variant(model):
         return "transformer.ln_f"
     elif isinstance(model, transformers.LlamaForCausalLM):
@@ -266,6 +361,8 @@ def determine_final_layer_norm_path(model: ModelandTokenizer | Model) -> str:
 
 def determine_lm_head_path(model: ModelandTokenizer | Model) -> str:
     model = unwrap_model(model)
+    import transformers
+
     if is_gpt_variant(model):
         return "lm_head"
     elif isinstance(model, transformers.LlamaForCausalLM):
@@ -278,6 +375,9 @@ def determine_lm_head_path(model: ModelandTokenizer | Model) -> str:
 
 def determine_layers(model: ModelandTokenizer | Model) -> tuple[int, ...]:
     """Return all hidden layer names for the given model."""
+    import transformers
+    from src.utils.typing import Model
+
     model = unwrap_model(model)
     assert isinstance(model, Model)
 
@@ -291,7 +391,7 @@ def determine_layers(model: ModelandTokenizer | Model) -> tuple[int, ...]:
     return (*range(n_layer),)
 
 
-from src.utils.typing import Layer, Sequence
+from src.utils.typing import Layer
 
 
 @overload
@@ -335,6 +435,9 @@ def determine_layer_paths(
         Mapping from layer number to layer path.
 
     """
+    import transformers
+    from src.utils.typing import Model
+
     model = unwrap_model(model)
 
     if layers is None:
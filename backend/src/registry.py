@@ -0,0 +1,104 @@
+import gc
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+import torch
+from src.models import ModelandTokenizer, get_model_size
+from src.scheduler import AttentionScheduler
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class RegisteredModel:
+    mt: ModelandTokenizer
+    scheduler: AttentionScheduler
+    size_mb: float
+
+
+class ModelRegistry:
+    """
+    Loads models on first use and keeps them, with their own scheduler, while they
+    fit in `budget_mb` (measured with `get_model_size`). When loading a model would
+    exceed the budget, the least recently used models are evicted first. The size
+    of a model is only known once it has been loaded, so the first load of a model
+    may overshoot the budget until the older models are evicted right after it.
+    """
+
+    def __init__(
+        self,
+        load_model: Callable[[str], ModelandTokenizer],
+        make_scheduler: Callable[[ModelandTokenizer], AttentionScheduler],
+        budget_mb: float,
+        allowed: Optional[list[str]] = None,
+    ) -> None:
+        self.load_model = load_model
+        self.make_scheduler = make_scheduler
+        self.budget_mb = budget_mb
+        self.allowed = allowed
+
+        self._models: OrderedDict[str, RegisteredModel] = OrderedDict()
+        self._sizes: dict[str, float] = {}  # of every model loaded so far
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()  # loads are serialized
+
+    def _lookup(self, name: str) -> Optional[RegisteredModel]:
+        with self._lock:
+            entry = self._models.get(name)
+            if entry is not None:
+                self._models.move_to_end(name)
+            return entry
+
+    def get(self, name: str) -> RegisteredModel:
+        """Raises `KeyError` if `name` is not one of the `allowed` models."""
+        if self.allowed is not None and name not in self.allowed:
+            raise KeyError(f"model {name!r} is not one of {self.allowed}")
+        entry = self._lookup(name)
+        if entry is not None:
+            return entry
+
+        with self._load_lock:
+            entry = self._lookup(name)  # another request may have loaded it
+            if entry is not None:
+                return entry
+            if name in self._sizes:
+                self._evict(keep_mb=self._sizes[name])
+
+            logger.info(f"loading model <{name}>")
+            mt = self.load_model(name)
+            size_mb = get_model_size(mt.model, unit="MB")
+            self._sizes[name] = size_mb
+            self._evict(keep_mb=size_mb)
+            entry = RegisteredModel(
+                mt=mt, scheduler=self.make_scheduler(mt), size_mb=size_mb
+            )
+            with self._lock:
+                self._models[name] = entry
+            return entry
+
+    def _evict(self, keep_mb: float) -> None:
+        """Evicts least recently used models until `keep_mb` more fits in the
+        budget (or no model is left)."""
+        while self._models and self.loaded_mb + keep_mb > self.budget_mb:
+            with self._lock:
+                name, entry = self._models.popitem(last=False)
+            logger.info(f"evicting model <{name}> ({entry.size_mb:.3f} MB)")
+            # requests already queued are still served before the scheduler stops
+            # and lets go of the model
+            entry.scheduler.close(timeout=0)
+            del entry
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+    @property
+    def loaded_mb(self) -> float:
+        with self._lock:
+            return sum(entry.size_mb for entry in self._models.values())
+
+    def items(self) -> list[tuple[str, RegisteredModel]]:
+        with self._lock:
+            return list(self._models.items())
@@ -0,0 +1,201 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+import torch
+from src.attention import AttentionInformation, get_attention_matrices
+from src.models import ModelandTokenizer
+from src.store import AttentionCache, result_nbytes
+from src.utils.metrics import DEVICE_PEAK_BYTES, RESULT_BYTES, STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class SchedulerClosed(RuntimeError):
+    """Raised when submitting to a scheduler that was closed."""
+
+
+@dataclass
+class AttentionRequest:
+    prompt: str
+    kwargs: dict[str, Any]
+    future: Future = field(default_factory=Future)
+    submitted_at: float = field(default_factory=time.perf_counter)
+
+    @property
+    def batch_key(self) -> tuple:
+        """Requests can only share a forward if they ask for the same mode."""
+        return tuple(sorted(self.kwargs.items()))
+
+
+class AttentionScheduler:
+    """
+    Owns the model and serves `get_attention_matrices` requests from a queue.
+    The worker thread blocks on the queue (no spinning) and, once a request arrives,
+    keeps gathering concurrent requests for up to `max_wait_ms` (or until
+    `max_batch_size` is reached) and runs them as a single padded forward.
+    If a `cache` is given, cached results are returned without queueing.
+    """
+
+    _STOP = object()
+
+    def __init__(
+        self,
+        mt: ModelandTokenizer,
+        max_batch_size: int = 8,
+        max_wait_ms: float = 5.0,
+        cache: Optional[AttentionCache] = None,
+    ) -> None:
+        assert max_batch_size > 0, "max_batch_size must be positive"
+        self.mt = mt
+        self.cache = cache
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        # held while the model is running. other code paths that need the model
+        # should acquire it to stay serialized with the batched forwards
+        self.model_lock = threading.Lock()
+
+        self._queue: queue.Queue = queue.Queue()
+        self._closed = False
+        self._submit_lock = threading.Lock()
+        self._worker = threading.Thread(
+            target=self._run, name="attention-scheduler", daemon=True
+        )
+        self._worker.start()
+
+    def submit(self, prompt: str, **kwargs: Any) -> Future:
+        """
+        Queue a prompt. `kwargs` are forwarded to `get_attention_matrices`.
+        Returns a `Future` that resolves to the prompt's `AttentionInformation`.
+        """
+        if not isinstance(prompt, str) or len(prompt) == 0:
+            raise ValueError("prompt must be a non-empty string")
+        request = AttentionRequest(prompt=prompt, kwargs=kwargs)
+        if self.cache is not None:
+            cached = self.cache.get(self.cache.make_key(self.mt, prompt, **kwargs))
+            if cached is not None:
+                request.future.set_result(cached)
+                return request.future
+        with self._submit_lock:
+            if self._closed:
+                raise SchedulerClosed(f"scheduler of {self.mt.name} is closed")
+            self._queue.put(request)
+        return request.future
+
+    def __call__(self, prompt: str, **kwargs: Any) -> AttentionInformation:
+        return self.submit(prompt, **kwargs).result()
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        """Stops the worker once the requests queued so far are served."""
+        with self._submit_lock:
+            if not self._closed:
+                self._closed = True
+                self._queue.put(self._STOP)
+        self._worker.join(timeout=timeout)
+
+    def _gather(self) -> tuple[list[AttentionRequest], bool]:
+        first = self._queue.get()
+        if first is self._STOP:
+            return [], True
+        batch = [first]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if request is self._STOP:
+                return batch, True
+            batch.append(request)
+        return batch, False
+
+    def _run(self) -> None:
+        while True:
+            batch, stop = self._gather()
+            groups: dict[tuple, list[AttentionRequest]] = {}
+            for request in batch:
+                if request.future.set_running_or_notify_cancel():
+                    groups.setdefault(request.batch_key, []).append(request)
+            for requests in groups.values():
+                try:
+                    self._process(requests)
+                except Exception as error:
+                    # the worker has to survive, or every future would hang
+                    logger.exception(f"serving a batch of {len(requests)} failed")
+                    self._fail(requests, error)
+            if stop:
+                return
+
+    @staticmethod
+    def _fail(requests: list[AttentionRequest], error: Exception) -> None:
+        for request in requests:
+            if not request.future.done():
+                request.future.set_exception(error)
+
+    def _process(self, requests: list[AttentionRequest]) -> None:
+        logger.info(
+            f"processing batch of {len(requests)} | "
+            + " | ".join(f"{r.prompt[:40]!r}" for r in requests)
+        )
+        for request in requests:
+            STAGE_SECONDS.observe(
+                time.perf_counter() - request.submitted_at, stage="queue_wait"
+            )
+        self._serve(requests)
+
+    def _forward(self, requests: list[AttentionRequest]) -> list:
+        on_cuda = self.mt.device.type == "cuda"
+        with self.model_lock:
+            if on_cuda:
+                torch.cuda.reset_peak_memory_stats(self.mt.device)
+            results = get_attention_matrices(
+                prompt=[r.prompt for r in requests],
+                mt=self.mt,
+                **requests[0].kwargs,
+            )
+            if on_cuda:
+                DEVICE_PEAK_BYTES.observe(
+                    torch.cuda.max_memory_allocated(self.mt.device)
+                )
+        assert len(results) == len(requests), "expected one result per prompt"
+        return results
+
+    def _serve(self, requests: list[AttentionRequest]) -> None:
+        try:
+            results = self._forward(requests)
+        except Exception as error:
+            if len(requests) > 1:
+                # one bad prompt should not fail the prompts batched with it
+                logger.warning(
+                    f"batch of {len(requests)} failed ({error!r}), retrying one by one"
+                )
+                for request in requests:
+                    self._serve([request])
+                return
+            logger.exception(f"prompt failed: {requests[0].prompt[:40]!r}")
+            self._fail(requests, error)
+            return
+        for request, result in zip(requests, results):
+            try:
+                RESULT_BYTES.observe(result_nbytes(result))
+                if self.cache is not None:
+                    self.cache.put(
+                        self.cache.make_key(self.mt, request.prompt, **request.kwargs),
+                        result,
+                    )
+            except Exception as error:
+                logger.exception(f"storing the result failed: {request.prompt[:40]!r}")
+                self._fail([request], error)
+                continue
+            request.future.set_result(result)
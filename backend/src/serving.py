@@ -0,0 +1,192 @@
+import logging
+import os
+import signal
+import socket
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+
+class Overloaded(Exception):
+    """Raised when a request can not be admitted. Clients should retry after
+    `retry_after` seconds."""
+
+    def __init__(self, message: str, retry_after: float) -> None:
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Bounds the number of requests that are running or waiting for the model.
+    Requests beyond `max_in_flight` are rejected right away with `Overloaded`
+    instead of piling up behind the model.
+    """
+
+    def __init__(self, max_in_flight: int, retry_after: float = 1.0) -> None:
+        assert max_in_flight > 0, "max_in_flight must be positive"
+        self.max_in_flight = max_in_flight
+        self.retry_after = retry_after
+        self._in_flight = 0
+        self._rejected = 0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        with self._lock:
+            if self._in_flight >= self.max_in_flight:
+                self._rejected += 1
+                raise Overloaded(
+                    f"{self._in_flight} requests in flight, try again later",
+                    retry_after=self.retry_after,
+                )
+            self._in_flight += 1
+
+    def release(self) -> None:
+        with self._lock:
+            assert self._in_flight > 0, "release without acquire"
+            self._in_flight -= 1
+
+    @contextmanager
+    def admit(self) -> Iterator[None]:
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    @property
+    def rejected(self) -> int:
+        return self._rejected
+
+
+def serve_asgi(app: Any, host: str, port: int, workers: int, **kwargs: Any) -> None:
+    """
+    Serves the (WSGI) Flask `app` behind an asyncio front end: uvicorn handles the
+    connections on the event loop and runs the requests on a pool of `workers`
+    threads, so that up to `workers` requests (and open streams) are handled at the
+    same time. Needs the optional `uvicorn` and `a2wsgi` packages.
+    """
+    try:
+        import uvicorn
+        from a2wsgi import WSGIMiddleware
+    except ImportError as error:
+        raise ImportError("the asgi server needs `pip install uvicorn a2wsgi`") from error
+
+    logger.info(f"serving with uvicorn on {host}:{port} with {workers} threads")
+    uvicorn.run(WSGIMiddleware(app, workers=workers), host=host, port=port, **kwargs)
+
+
+def available_cores() -> list[int]:
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def split_cores(
+    n_workers: int, worker_cores: Optional[Sequence[Sequence[int]]] = None
+) -> list[list[int]]:
+    """
+    The cores of each of `n_workers` workers: `worker_cores` if given (one list of
+    core ids per worker, e.g. the cores of one NUMA node each), otherwise the
+    available cores split into `n_workers` contiguous groups of about the same size.
+    """
+    if worker_cores is not None:
+        if len(worker_cores) != n_workers:
+            raise ValueError(
+                f"worker_cores has {len(worker_cores)} groups for {n_workers} workers"
+            )
+        if any(len(cores) == 0 for cores in worker_cores):
+            raise ValueError("every worker needs at least one core")
+        return [list(cores) for cores in worker_cores]
+    cores = available_cores()
+    if len(cores) < n_workers:
+        raise ValueError(f"{n_workers} workers for {len(cores)} cores")
+    size, extra = divmod(len(cores), n_workers)
+    groups, start = [], 0
+    for rank in range(n_workers):
+        stop = start + size + (rank < extra)
+        groups.append(cores[start:stop])
+        start = stop
+    return groups
+
+
+def pin_to_cores(cores: Sequence[int]) -> None:
+    """Restricts the current process to `cores` and sizes torch's intra-op thread
+    pool to match, so that the workers do not compete for the same cores."""
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    else:
+        logger.warning("cpu affinity is not supported here, only limiting threads")
+    import torch
+
+    torch.set_num_threads(len(cores))
+
+
+def serve_prefork(
+    init_worker: Callable[[], Any],
+    app: Any,
+    host: str,
+    port: int,
+    n_workers: int,
+    worker_cores: Optional[Sequence[Sequence[int]]] = None,
+) -> None:
+    """
+    Binds the listening socket once, then forks `n_workers` processes that each call
+    `init_worker()` (e.g. to load the model and start its scheduler, which must
+    happen after the fork) and serve `app` on the shared socket with werkzeug's
+    threaded server. The kernel spreads the connections over the workers.
+
+    Each worker is pinned to its own group of cores (see `split_cores`), with as
+    many torch threads as cores, instead of every worker starting a thread per core.
+    """
+    from werkzeug.serving import make_server
+
+    core_groups = split_cores(n_workers, worker_cores)
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(128)
+    sock.set_inheritable(True)
+
+    workers = []
+    for rank in range(n_workers):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                pin_to_cores(core_groups[rank])
+                logger.info(
+                    f"worker {rank} (pid {os.getpid()}) starting"
+                    f" on cores {core_groups[rank]}"
+                )
+                init_worker()
+                server = make_server(host, port, app, threaded=True, fd=sock.fileno())
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            except BaseException:
+                logger.exception(f"worker {rank} failed")
+                code = 1
+            finally:
+                os._exit(code)
+        workers.append(pid)
+    logger.info(f"serving on {host}:{port} with {n_workers} workers {workers}")
+
+    def stop(signum, frame):
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for pid in workers:
+        os.waitpid(pid, 0)
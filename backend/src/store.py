@@ -0,0 +1,184 @@
+import logging
+import threading
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Hashable, Optional
+
+import numpy as np
+import torch
+from dataclasses_json import DataClassJsonMixin
+from src.models import ModelandTokenizer, determine_dtype
+from src.utils.disk_store import DiskStore
+
+logger = logging.getLogger(__name__)
+
+
+class ResultStore:
+    """
+    Keeps the most recent results in memory under a random id, so that clients can
+    fetch slices of a result instead of downloading the whole thing up front.
+    Results are dropped oldest-access first once the bytes of their arrays (see
+    `result_nbytes`) exceed `max_bytes`. The newest result is always kept, even if
+    it is larger than `max_bytes` on its own, so that its id stays valid.
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        assert max_bytes > 0, "max_bytes must be positive"
+        self.max_bytes = max_bytes
+        self._results: OrderedDict[str, tuple[Any, int]] = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    def put(self, result: Any, result_id: Optional[str] = None) -> str:
+        """Stores `result` under `result_id` (replacing any previous result), or
+        under a fresh random id if not given. Returns the id."""
+        result_id = uuid.uuid4().hex if result_id is None else result_id
+        nbytes = result_nbytes(result)
+        with self._lock:
+            if result_id in self._results:
+                self._nbytes -= self._results.pop(result_id)[1]
+            self._results[result_id] = (result, nbytes)
+            self._nbytes += nbytes
+            while self._nbytes > self.max_bytes and len(self._results) > 1:
+                dropped, (_, dropped_nbytes) = self._results.popitem(last=False)
+                self._nbytes -= dropped_nbytes
+                logger.debug(f"dropped result {dropped} from store")
+        return result_id
+
+    def get(self, result_id: str) -> Any:
+        """Raises `KeyError` if the result is unknown or was already dropped."""
+        with self._lock:
+            result, _ = self._results[result_id]
+            self._results.move_to_end(result_id)
+        return result
+
+    def __contains__(self, result_id: str) -> bool:
+        with self._lock:
+            return result_id in self._results
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._results)
+
+    @property
+    def nbytes(self) -> int:
+        with self._lock:
+            return self._nbytes
+
+
+def result_nbytes(result: Any) -> int:
+    """Total size of the numpy arrays and tensors held in the fields of `result`,
+    including the ones nested in tuples, lists and dataclasses (e.g. a kv cache)."""
+    if isinstance(result, np.ndarray):
+        return result.nbytes
+    if isinstance(result, torch.Tensor):
+        return result.nelement() * result.element_size()
+    if isinstance(result, (tuple, list)):
+        return sum(result_nbytes(value) for value in result)
+    if hasattr(result, "__dict__"):
+        return sum(result_nbytes(value) for value in result.__dict__.values())
+    return 0
+
+
+@dataclass
+class CacheStats(DataClassJsonMixin):
+    hits: int = 0
+    misses: int = 0
+    disk_hits: int = 0  # misses in memory that were found in the disk store
+    evictions: int = 0
+    entries: int = 0
+    nbytes: int = 0
+    max_bytes: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        """Fraction of lookups served from memory or disk."""
+        lookups = self.hits + self.disk_hits + self.misses
+        return (self.hits + self.disk_hits) / lookups if lookups > 0 else 0.0
+
+
+class AttentionCache:
+    """
+    LRU cache of computed results. Eviction is based on the total bytes of the
+    arrays stored in the cached results (see `result_nbytes`), not on entry count.
+    Results larger than `max_bytes` on their own are not cached.
+
+    With a `disk` store, results are also written to disk in the background, and
+    misses in memory are looked up there (and kept in memory again) before they
+    count as misses.
+    """
+
+    def __init__(self, max_bytes: int, disk: Optional[DiskStore] = None) -> None:
+        assert max_bytes > 0, "max_bytes must be positive"
+        self.max_bytes = max_bytes
+        self.disk = disk
+        self._entries: OrderedDict[Hashable, tuple[Any, int]] = OrderedDict()
+        self._nbytes = 0
+        self._hits = self._misses = self._evictions = self._disk_hits = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(mt: ModelandTokenizer, prompt: str, **kwargs: Any) -> tuple:
+        """(model name, dtype, prompt, mode) where the mode is given by the kwargs
+        to `get_attention_matrices`, e.g. `value_weighted`."""
+        return (
+            mt.name,
+            str(determine_dtype(mt)),
+            prompt,
+            tuple(sorted(kwargs.items())),
+        )
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._hits += 1
+                self._entries.move_to_end(key)
+                return entry[0]
+        result = self.disk.get(key) if self.disk is not None else None
+        with self._lock:
+            if result is None:
+                self._misses += 1
+                return None
+            self._disk_hits += 1
+        self._put_in_memory(key, result)
+        return result
+
+    def put(self, key: Hashable, result: Any) -> None:
+        if self.disk is not None:
+            # `put` runs on the inference thread, which should not wait for the disk
+            self.disk.put_later(key, result)
+        self._put_in_memory(key, result)
+
+    def _put_in_memory(self, key: Hashable, result: Any) -> None:
+        nbytes = result_nbytes(result)
+        if nbytes > self.max_bytes:
+            logger.debug(f"not caching result of {nbytes} bytes > {self.max_bytes=}")
+            return
+        with self._lock:
+            if key in self._entries:
+                self._nbytes -= self._entries.pop(key)[1]
+            self._entries[key] = (result, nbytes)
+            self._nbytes += nbytes
+            while self._nbytes > self.max_bytes:
+                _, (_, evicted_nbytes) = self._entries.popitem(last=False)
+                self._nbytes -= evicted_nbytes
+                self._evictions += 1
+
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return CacheStats(
+                hits=self._hits,
+                misses=self._misses,
+                disk_hits=self._disk_hits,
+                evictions=self._evictions,
+                entries=len(self._entries),
+                nbytes=self._nbytes,
+                max_bytes=self.max_bytes,
+            )
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
@@ -0,0 +1,374 @@
+"""
+Hidden states of many (prompt, subject) pairs on disk, for datasets larger than
+memory. A store is a directory with
+
+    meta.json           layers, hidden size, dtype and rows per shard
+    index.jsonl         one line per stored row: {"prompt_id": ..., "subject": ...}
+                        (prompt ids are ints or strings, to round trip through JSON)
+    shard-00000.npy     (shard_size, len(layers), hidden size) arrays
+    ...
+
+Row `i` of the store is line `i` of the index and row `i % shard_size` of shard
+`i // shard_size`. Rows are written to the memory-mapped shards first, and their
+index lines are appended only after the shards are flushed, so the index never
+refers to missing data: after a crash, a writer opened on the same directory
+resumes after the last indexed row.
+"""
+import json
+import logging
+import os
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Hashable, Iterable, Optional, Sequence, Union
+
+import numpy as np
+from src.utils.disk_store import META_FILE, _as_array
+from src.utils.env_utils import PathLike
+
+if TYPE_CHECKING:
+    import torch
+    from src.models import ModelandTokenizer
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILE = "index.jsonl"
+
+Key = tuple[Hashable, str]  # (prompt id, subject)
+
+
+def _shard_path(root: Path, shard: int) -> Path:
+    return root / f"shard-{shard:05d}.npy"
+
+
+def _read_meta(root: Path) -> dict:
+    with open(root / META_FILE) as handle:
+        return json.load(handle)
+
+
+def _read_index(root: Path, repair: bool = False) -> list[Key]:
+    """The keys of the indexed rows. A last line without a newline was cut off by
+    a crash, it is ignored, and removed from the file if `repair`."""
+    path = root / INDEX_FILE
+    if not path.exists():
+        return []
+    with open(path, "rb") as handle:
+        content = handle.read()
+    complete = content[: content.rfind(b"\n") + 1]
+    if len(complete) < len(content):
+        logger.warning(f"ignoring a partial line at the end of {path}")
+        if repair:
+            with open(path, "r+b") as handle:
+                handle.truncate(len(complete))
+    keys = []
+    for line in complete.decode().splitlines():
+        record = json.loads(line)
+        keys.append((record["prompt_id"], record["subject"]))
+    return keys
+
+
+def _as_prompt_id(prompt_id: Any) -> Union[int, str]:
+    """`prompt_id` as an int or a string, the ids that round trip through the JSON
+    index. Numpy scalars are converted, e.g. ids taken from an array."""
+    if isinstance(prompt_id, np.generic):
+        prompt_id = prompt_id.item()
+    if isinstance(prompt_id, bool) or not isinstance(prompt_id, (int, str)):
+        raise ValueError(
+            f"prompt ids must be ints or strings, got {type(prompt_id).__name__}"
+        )
+    return prompt_id
+
+
+class ActivationWriter:
+    """
+    Appends hidden states of shape (len(layers), hidden size) to the store at
+    `root`, creating it if needed. If `root` is an existing store, its layers,
+    hidden size and dtype have to match, and writing continues after its last
+    indexed row.
+
+    Rows are indexed, and so visible to readers, when `flush` is called: at the
+    end of every `append_batch`, every `flush_every` calls to `append` and on
+    `close`.
+    """
+
+    def __init__(
+        self,
+        root: PathLike,
+        layers: Sequence[str],
+        hidden_size: int,
+        shard_size: int = 4096,
+        dtype: np.dtype = np.float16,
+        flush_every: int = 256,
+    ) -> None:
+        self.root = Path(root)
+        meta = {
+            "layers": list(layers),
+            "hidden_size": int(hidden_size),
+            "dtype": np.dtype(dtype).name,
+            "shard_size": int(shard_size),
+        }
+        if (self.root / META_FILE).exists():
+            stored = _read_meta(self.root)
+            for field in ("layers", "hidden_size", "dtype"):
+                if stored[field] != meta[field]:
+                    raise ValueError(
+                        f"{self.root} has {field}={stored[field]}, not {meta[field]}"
+                    )
+            meta = stored  # keep the stored shard size
+        else:
+            self.root.mkdir(parents=True, exist_ok=True)
+            with open(self.root / META_FILE, "w") as handle:
+                json.dump(meta, handle)
+        self.layers = meta["layers"]
+        self.hidden_size = meta["hidden_size"]
+        self.dtype = np.dtype(meta["dtype"])
+        self.shard_size = meta["shard_size"]
+        self.flush_every = flush_every
+
+        keys = _read_index(self.root, repair=True)
+        self._rows = {key: row for row, key in enumerate(keys)}
+        assert len(self._rows) == len(keys), f"{self.root} has duplicate keys"
+        if len(keys) > 0:
+            logger.info(f"resuming {self.root} after {len(keys)} rows")
+        self._pending: dict[Key, None] = {}  # written, not indexed yet, in order
+        self._shards: dict[int, np.memmap] = {}
+        self._index = open(self.root / INDEX_FILE, "a")
+
+    def __len__(self) -> int:
+        """Rows written, including the ones not flushed yet."""
+        return len(self._rows) + len(self._pending)
+
+    def __contains__(self, key: Key) -> bool:
+        return key in self._rows or key in self._pending
+
+    def _shard(self, shard: int) -> np.memmap:
+        if shard not in self._shards:
+            path = _shard_path(self.root, shard)
+            if path.exists():
+                array = np.load(path, mmap_mode="r+")
+            else:
+                # the file is sparse, pages are only allocated as rows are written
+                array = np.lib.format.open_memmap(
+                    path,
+                    mode="w+",
+                    dtype=self.dtype,
+                    shape=(self.shard_size, len(self.layers), self.hidden_size),
+                )
+            # a finished shard is not written again
+            for other in [s for s in self._shards if s < shard]:
+                self._shards.pop(other).flush()
+            self._shards[shard] = array
+        return self._shards[shard]
+
+    def append(self, prompt_id: Hashable, subject: str, h: Any) -> int:
+        """Stores `h` (array or tensor of shape (len(layers), hidden size)) and
+        returns its row."""
+        # checked before anything is written, the index only takes ints and strings
+        if not isinstance(subject, str):
+            raise ValueError(f"subjects must be strings, got {type(subject).__name__}")
+        key = (_as_prompt_id(prompt_id), subject)
+        if key in self:
+            raise ValueError(f"{key} is already stored in {self.root}")
+        h = _as_array(h)
+        expected = (len(self.layers), self.hidden_size)
+        if h is None or h.shape != expected:
+            raise ValueError(f"expected an array of shape {expected}")
+        row = len(self)
+        shard, offset = divmod(row, self.shard_size)
+        self._shard(shard)[offset] = h
+        self._pending[key] = None
+        if len(self._pending) >= self.flush_every:
+            self.flush()
+        return row
+
+    def append_batch(
+        self, prompt_ids: Sequence[Hashable], subjects: Sequence[str], h: Any
+    ) -> list[int]:
+        """Stores `h[i]` for every (prompt_ids[i], subjects[i]), with `h` of shape
+        (n, len(layers), hidden size), e.g. from `get_h_batched`."""
+        assert len(prompt_ids) == len(subjects) == len(h), "need one row per key"
+        h = _as_array(h)
+        rows = []
+        for i, (prompt_id, subject) in enumerate(zip(prompt_ids, subjects)):
+            rows.append(self.append(prompt_id, subject, h[i]))
+        self.flush()
+        return rows
+
+    def flush(self) -> None:
+        """Writes the shards to disk, then indexes the rows written since the last
+        flush."""
+        if len(self._pending) == 0:
+            return
+        for array in self._shards.values():
+            array.flush()
+        lines = "".join(
+            json.dumps({"prompt_id": prompt_id, "subject": subject}) + "\n"
+            for prompt_id, subject in self._pending
+        )
+        self._index.write(lines)
+        self._index.flush()
+        os.fsync(self._index.fileno())
+        for key in self._pending:
+            self._rows[key] = len(self._rows)
+        self._pending = {}
+
+    def close(self) -> None:
+        if self._index.closed:
+            return
+        self.flush()
+        self._index.close()
+        self._shards = {}
+
+    def __enter__(self) -> "ActivationWriter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+class ActivationReader:
+    """
+    Random access to a store written by `ActivationWriter`. The shards are memory
+    mapped copy-on-write, so `get` and `shard` return views into the page cache
+    without reading the store into memory, and the views can be wrapped by
+    `torch.from_numpy` without a copy. Writes to the views stay in this process.
+
+    The reader sees the rows indexed when it was opened, `refresh` picks up rows
+    a writer indexed since.
+    """
+
+    def __init__(self, root: PathLike) -> None:
+        self.root = Path(root)
+        meta = _read_meta(self.root)
+        self.layers: list[str] = meta["layers"]
+        self.hidden_size: int = meta["hidden_size"]
+        self.dtype = np.dtype(meta["dtype"])
+        self.shard_size: int = meta["shard_size"]
+        self._layer_idx = {layer: i for i, layer in enumerate(self.layers)}
+        self._shards: dict[int, np.memmap] = {}
+        self.refresh()
+
+    def refresh(self) -> None:
+        self.keys = _read_index(self.root)
+        self._rows = {key: row for row, key in enumerate(self.keys)}
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def __contains__(self, key: Key) -> bool:
+        return key in self._rows
+
+    @property
+    def n_shards(self) -> int:
+        return -(-len(self) // self.shard_size)
+
+    def row(self, prompt_id: Hashable, subject: str) -> int:
+        key = (prompt_id, subject)
+        if key not in self._rows:
+            raise KeyError(f"{key} is not in {self.root}")
+        return self._rows[key]
+
+    def shard(self, shard: int) -> np.ndarray:
+        """The indexed rows of `shard`, (rows, len(layers), hidden size)."""
+        assert 0 <= shard < self.n_shards, f"{self.root} has {self.n_shards} shards"
+        if shard not in self._shards:
+            self._shards[shard] = np.load(_shard_path(self.root, shard), mmap_mode="c")
+        n_rows = min(self.shard_size, len(self) - shard * self.shard_size)
+        return self._shards[shard][:n_rows]
+
+    def _layer(self, layer: Union[str, int, None]) -> Union[int, slice]:
+        if layer is None:
+            return slice(None)
+        if isinstance(layer, str):
+            return self._layer_idx[layer]
+        return layer
+
+    def get_row(self, row: int, layer: Union[str, int, None] = None) -> np.ndarray:
+        shard, offset = divmod(row, self.shard_size)
+        return self.shard(shard)[offset, self._layer(layer)]
+
+    def get(
+        self, prompt_id: Hashable, subject: str, layer: Union[str, int, None] = None
+    ) -> np.ndarray:
+        """A view of the hidden states of (prompt_id, subject) at `layer` (name or
+        position in `layers`), or at every layer if None."""
+        return self.get_row(self.row(prompt_id, subject), layer=layer)
+
+    def get_tensor(
+        self, prompt_id: Hashable, subject: str, layer: Union[str, int, None] = None
+    ) -> "torch.Tensor":
+        import torch
+
+        return torch.from_numpy(self.get(prompt_id, subject, layer=layer))
+
+    def gather(
+        self, rows: Iterable[int], layer: Union[str, int, None] = None
+    ) -> np.ndarray:
+        """The hidden states of `rows`, in that order, e.g. a shuffled batch for a
+        probe. Unlike the views, this copies the rows into memory."""
+        rows = np.asarray(list(rows), dtype=np.int64)
+        layer_idx = self._layer(layer)
+        shape = (self.hidden_size,)
+        if layer is None:
+            shape = (len(self.layers), self.hidden_size)
+        out = np.empty((len(rows), *shape), dtype=self.dtype)
+        shards, offsets = np.divmod(rows, self.shard_size)
+        for shard in np.unique(shards):
+            in_shard = shards == shard
+            out[in_shard] = self.shard(int(shard))[offsets[in_shard]][:, layer_idx]
+        return out
+
+
+def collect_activations(
+    mt: "ModelandTokenizer",
+    root: PathLike,
+    prompt_ids: Sequence[Hashable],
+    prompts: Sequence[str],
+    subjects: Sequence[str],
+    layers: Sequence[str],
+    mode: str = "output",
+    chunk_size: int = 1024,
+    batch_size: int = 32,
+    max_batch_tokens: Optional[int] = None,
+    shard_size: int = 4096,
+    dtype: np.dtype = np.float16,
+) -> ActivationReader:
+    """
+    Runs `get_h_batched` over the (prompt, subject) pairs that are not in the store
+    at `root` yet, `chunk_size` pairs at a time, and appends the hidden states.
+    Every chunk is flushed, so an interrupted run resumes from its last chunk when
+    called again with the same arguments.
+
+    Returns:
+        a reader of the store
+    """
+    from src.functional import get_h_batched
+
+    assert len(prompt_ids) == len(prompts) == len(subjects), "need one id per pair"
+    with ActivationWriter(
+        root,
+        layers=layers,
+        hidden_size=mt.n_embd,
+        shard_size=shard_size,
+        dtype=dtype,
+    ) as writer:
+        todo = [
+            i
+            for i, key in enumerate(zip(prompt_ids, subjects))
+            if key not in writer
+        ]
+        logger.info(f"{len(todo)} of {len(prompts)} pairs left to collect in {root}")
+        for start in range(0, len(todo), chunk_size):
+            chunk = todo[start : start + chunk_size]
+            h = get_h_batched(
+                mt,
+                prompts=[prompts[i] for i in chunk],
+                subjects=[subjects[i] for i in chunk],
+                layers=list(layers),
+                mode=mode,
+                batch_size=batch_size,
+                max_batch_tokens=max_batch_tokens,
+            )
+            writer.append_batch(
+                [prompt_ids[i] for i in chunk], [subjects[i] for i in chunk], h
+            )
+            logger.debug(f"collected {start + len(chunk)}/{len(todo)} pairs")
+    return ActivationReader(root)
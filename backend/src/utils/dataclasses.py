@@ -1,6 +1,7 @@
 from dataclasses import dataclass
 from typing import Any, Optional, Union
 
+import numpy as np
 from dataclasses_json import DataClassJsonMixin
 from src.utils.typing import Layer
 
@@ -14,3 +15,14 @@ class PredictedToken(DataClassJsonMixin):
 
     def __str__(self) -> str:
         return f'"{self.token}" (p={self.prob:.3f})'
+
+
+@dataclass(frozen=True)
+class PredictedTokenArrays(DataClassJsonMixin):
+    """Predicted tokens of several prompts as arrays, without decoding them: ids
+    and probabilities of shape (prompts, k), or (prompts,) for a single token per
+    prompt, which then also has its rank (1 = most likely)."""
+
+    token_ids: np.ndarray
+    probs: np.ndarray
+    ranks: Optional[np.ndarray] = None
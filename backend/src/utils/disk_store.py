@@ -0,0 +1,233 @@
+"""Results with large arrays on disk, as a small `meta.json` next to one `.npy` file
+per array field. Arrays are read back memory-mapped, so loading a result does not
+read (or parse) the arrays until they are used, and processes that load the same
+result share its pages.
+"""
+import dataclasses
+import hashlib
+import importlib
+import json
+import logging
+import os
+import queue
+import shutil
+import sys
+import threading
+import uuid
+from pathlib import Path
+from typing import Any, Hashable, Iterator, Optional
+
+import numpy as np
+from src.utils.env_utils import PathLike
+
+logger = logging.getLogger(__name__)
+
+META_FILE = "meta.json"
+
+
+def _is_tensor(value: Any) -> bool:
+    torch = sys.modules.get("torch")  # there are no tensors if torch is not imported
+    return torch is not None and isinstance(value, torch.Tensor)
+
+
+def _as_array(value: Any) -> Optional[np.ndarray]:
+    """`value` as a numpy array if it is an array or a tensor, otherwise None."""
+    if isinstance(value, np.ndarray):
+        return value
+    if _is_tensor(value):
+        value = value.detach().cpu()
+        if value.is_floating_point():
+            value = value.float()  # numpy has no bfloat16
+        return value.numpy()
+    return None
+
+
+def has_array_fields(result: Any) -> bool:
+    return any(
+        isinstance(value, np.ndarray) or _is_tensor(value)
+        for value in result.__dict__.values()
+    )
+
+
+def save_result(result: Any, path: PathLike, dtype: np.dtype = np.float16) -> Path:
+    """
+    Saves the dataclass `result` to the directory `path`. Floating point arrays and
+    tensors are stored as `dtype`, other arrays keep their dtype. The remaining
+    fields have to be JSON serializable. The directory is written under a temporary
+    name and renamed when complete, so readers never see a partial result.
+    """
+    path = Path(path)
+    tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}")
+    tmp_path.mkdir(parents=True)
+    try:
+        fields, arrays = {}, []
+        for name, value in result.__dict__.items():
+            array = _as_array(value)
+            if array is None:
+                fields[name] = value
+                continue
+            if np.issubdtype(array.dtype, np.floating):
+                array = array.astype(dtype, copy=False)
+            np.save(tmp_path / f"{name}.npy", array)
+            arrays.append(name)
+        meta = {
+            "type": f"{type(result).__module__}.{type(result).__qualname__}",
+            "arrays": arrays,
+            "fields": fields,
+        }
+        with open(tmp_path / META_FILE, "w") as handle:
+            json.dump(meta, handle)
+        if path.exists():
+            shutil.rmtree(path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+    return path
+
+
+def load_result(path: PathLike, result_type: Optional[type] = None) -> Any:
+    """
+    Loads a result saved with `save_result`, with its arrays memory-mapped
+    read-only. `result_type` defaults to the type the result was saved from.
+    """
+    path = Path(path)
+    with open(path / META_FILE) as handle:
+        meta = json.load(handle)
+    if result_type is None:
+        module, _, name = meta["type"].rpartition(".")
+        result_type = getattr(importlib.import_module(module), name)
+    arrays = {
+        name: np.load(path / f"{name}.npy", mmap_mode="r") for name in meta["arrays"]
+    }
+    return result_type(**meta["fields"], **arrays)
+
+
+def _directory_nbytes(path: Path) -> int:
+    return sum(file.stat().st_size for file in path.iterdir() if file.is_file())
+
+
+class DiskStore:
+    """
+    Content-addressed results on disk: a result is saved under the hash of its key
+    (e.g. `AttentionCache.make_key`, i.e. model, prompt and mode), so the same
+    directory can be shared by several workers and survives restarts.
+
+    With `max_bytes`, the least recently used results (by the modification time of
+    their `meta.json`, which `get` updates) are deleted once the results take more
+    than that. Every worker only estimates the size of the store and rescans the
+    directory when the estimate is over budget, so workers sharing a directory
+    keep it within about one result of the budget.
+
+    `put_later` writes on a background thread, so that callers on the inference
+    thread do not wait for the disk. At most `max_pending` results wait to be
+    written, further ones are not stored.
+    """
+
+    def __init__(
+        self,
+        root: PathLike,
+        dtype: np.dtype = np.float16,
+        max_bytes: Optional[int] = None,
+        max_pending: int = 16,
+    ) -> None:
+        assert max_bytes is None or max_bytes > 0, "max_bytes must be positive"
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.dtype = dtype
+        self.max_bytes = max_bytes
+        self._nbytes = sum(nbytes for _, nbytes, _ in self._entries())
+        self._lock = threading.Lock()
+        self._pending: queue.Queue = queue.Queue(maxsize=max_pending)
+        self._writer: Optional[threading.Thread] = None
+
+    def path(self, key: Hashable) -> Path:
+        digest = hashlib.sha256(repr(key).encode()).hexdigest()
+        return self.root / digest[:2] / digest
+
+    def __contains__(self, key: Hashable) -> bool:
+        return (self.path(key) / META_FILE).exists()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        path = self.path(key)
+        if not (path / META_FILE).exists():
+            return None
+        try:
+            result = load_result(path)
+            os.utime(path / META_FILE)  # recently used, evicted last
+            return result
+        except (OSError, ValueError) as error:
+            logger.warning(f"could not load {path}: {error}")
+            return None
+
+    def put(self, key: Hashable, result: Any) -> None:
+        assert dataclasses.is_dataclass(result), "only dataclasses can be stored"
+        if key in self:  # results are immutable, the stored one is as good
+            return
+        path = self.path(key)
+        try:
+            save_result(result, path, dtype=self.dtype)
+        except OSError as error:  # another worker stored it at the same time
+            if key not in self:
+                raise
+            logger.debug(f"{path} was stored concurrently: {error}")
+            return
+        if self.max_bytes is not None:
+            with self._lock:
+                self._nbytes += _directory_nbytes(path)
+                over_budget = self._nbytes > self.max_bytes
+            if over_budget:
+                self.evict()
+
+    def put_later(self, key: Hashable, result: Any) -> None:
+        """Like `put`, on the background writer thread."""
+        assert dataclasses.is_dataclass(result), "only dataclasses can be stored"
+        with self._lock:
+            if self._writer is None:
+                self._writer = threading.Thread(
+                    target=self._write, name="disk-store-writer", daemon=True
+                )
+                self._writer.start()
+        try:
+            self._pending.put_nowait((key, result))
+        except queue.Full:
+            logger.debug(f"{self._pending.maxsize} writes pending, not storing {key}")
+
+    def _write(self) -> None:
+        while True:
+            key, result = self._pending.get()
+            try:
+                self.put(key, result)
+            except Exception:
+                logger.exception(f"could not store {self.path(key)}")
+            finally:
+                self._pending.task_done()
+
+    def flush(self) -> None:
+        """Waits until the results passed to `put_later` so far are written."""
+        self._pending.join()
+
+    def _entries(self) -> Iterator[tuple[float, int, Path]]:
+        """(last use, bytes, path) of every stored result."""
+        for meta in self.root.glob(f"*/*/{META_FILE}"):
+            try:
+                yield meta.stat().st_mtime, _directory_nbytes(meta.parent), meta.parent
+            except OSError:  # deleted by another worker meanwhile
+                continue
+
+    def evict(self) -> None:
+        """Deletes the least recently used results until the store fits in
+        `max_bytes`."""
+        if self.max_bytes is None:
+            return
+        entries = sorted(self._entries())
+        nbytes = sum(entry_nbytes for _, entry_nbytes, _ in entries)
+        for _, entry_nbytes, path in entries:
+            if nbytes <= self.max_bytes:
+                break
+            # readers that mapped the arrays keep them until they let go
+            shutil.rmtree(path, ignore_errors=True)
+            nbytes -= entry_nbytes
+            logger.debug(f"evicted {path} from the disk store")
+        with self._lock:
+            self._nbytes = nbytes
@@ -13,8 +13,6 @@ from typing import Optional, TypeVar, Union
 from src.utils import env_utils
 from src.utils.env_utils import PathLike
 
-import numpy
-import torch
 from dataclasses_json import DataClassJsonMixin
 
 logger = logging.getLogger(__name__)
@@ -33,6 +31,9 @@ class Experiment:
 
 def set_seed(seed: int) -> None:
     """Globally set random seed."""
+    import numpy
+    import torch
+
     logger.info("setting all seeds to %d", seed)
     random.seed(seed)
     numpy.random.seed(seed)
@@ -96,7 +97,11 @@ def load_results_file(
     name: str,
     resume: bool,
 ) -> Union[ResultsT, None]:
-    """Read an intermediate result, if present."""
+    """Read an intermediate result, if present.
+
+    Results saved with their arrays in a directory (see `save_results_file`) are
+    read with the arrays memory-mapped.
+    """
     if results_dir is None or not resume:
         logger.debug("results_dir not set, so not reading intermediate results")
         return None
@@ -105,6 +110,12 @@ def load_results_file(
         results_dir=results_dir,
         name=name,
     )
+    from src.utils import disk_store
+
+    arrays_dir = relation_results_file.with_suffix("")
+    if (arrays_dir / disk_store.META_FILE).exists():
+        logger.debug(f"reading intermediate results from {arrays_dir}")
+        return disk_store.load_result(arrays_dir, result_type=results_type)
     if not relation_results_file.exists():
         logger.debug(f'no intermediate results for "{name}"')
         return None
@@ -120,15 +131,26 @@ def save_results_file(
     name: str,
     results: ResultsT,
 ) -> None:
-    """Save an intermediate result."""
+    """Save an intermediate result.
+
+    Results with array or tensor fields are saved as a directory with the arrays in
+    float16 `.npy` files (see `disk_store.save_result`), everything else as JSON.
+    """
     if results_dir is None:
         logger.debug(
             "results_dir not set, so not saving intermediate results for " f'"{name}"'
         )
         return None
     relation_results_file = name_results_file(results_dir=results_dir, name=name)
-    logger.debug(f"saving intermediate results to {relation_results_file}")
     relation_results_file.parent.mkdir(exist_ok=True, parents=True)
+    from src.utils import disk_store
+
+    if disk_store.has_array_fields(results):
+        arrays_dir = relation_results_file.with_suffix("")
+        logger.debug(f"saving intermediate results to {arrays_dir}")
+        disk_store.save_result(results, arrays_dir)
+        return None
+    logger.debug(f"saving intermediate results to {relation_results_file}")
     with relation_results_file.open("w") as handle:
         handle.write(results.to_json(indent=4))
 
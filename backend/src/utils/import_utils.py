@@ -0,0 +1,117 @@
+"""Measure how long importing a module takes, and what it spends the time on.
+
+    python -m src.utils.import_utils src.functional src.utils.experiment_utils
+    python -m src.utils.import_utils src.models --budget-ms 300
+
+Every module is imported in a fresh interpreter with `python -X importtime`, so the
+numbers do not depend on what this process has already imported. With
+`--budget-ms`, the exit code is 1 if any of the modules takes longer than that.
+"""
+import argparse
+import logging
+import subprocess
+import sys
+from dataclasses import dataclass
+
+from src.utils import logging_utils
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class ImportTime:
+    """One line of `-X importtime`. Times are in microseconds."""
+
+    module: str
+    self_us: int
+    cumulative_us: int
+    depth: int
+
+
+def measure_import_time(module: str) -> list[ImportTime]:
+    """Imports `module` in a new interpreter. Returns the timings in the order the
+    imports finished, so every module comes after the modules it imported."""
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+    )
+    if process.returncode != 0:
+        raise RuntimeError(f"importing {module} failed:\n{process.stderr}")
+
+    timings = []
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        timings.append(
+            ImportTime(
+                module=name.strip(),
+                self_us=int(self_us),
+                cumulative_us=int(cumulative_us),
+                depth=depth,
+            )
+        )
+    return timings
+
+
+def direct_imports(timings: list[ImportTime], module: str) -> list[ImportTime]:
+    """The imports of `module` that were not already imported before it, with the
+    time spent in each of them (including their own imports)."""
+    root = max(
+        (i for i, timing in enumerate(timings) if timing.module == module),
+        default=None,
+    )
+    if root is None:  # already imported by the interpreter itself
+        return []
+    children = []
+    for timing in reversed(timings[:root]):
+        if timing.depth <= timings[root].depth:
+            break
+        if timing.depth == timings[root].depth + 1:
+            children.append(timing)
+    return sorted(children, key=lambda timing: -timing.cumulative_us)
+
+
+def import_report(module: str, top: int = 10) -> tuple[float, str]:
+    """Returns the total import time of `module` in ms and a readable breakdown."""
+    timings = measure_import_time(module)
+    # the interpreter's own startup imports are in the timings too, only count
+    # the module and the packages it is in
+    parts = module.split(".")
+    packages = {".".join(parts[: i + 1]) for i in range(len(parts))}
+    total_ms = (
+        sum(
+            timing.cumulative_us
+            for timing in timings
+            if timing.depth == 0 and timing.module in packages
+        )
+        / 1000
+    )
+    lines = [f"import {module}: {total_ms:.1f} ms"]
+    for timing in direct_imports(timings, module)[:top]:
+        lines.append(f"  {timing.cumulative_us / 1000:9.1f} ms  {timing.module}")
+    return total_ms, "\n".join(lines)
+
+
+def main(args: argparse.Namespace) -> None:
+    logging_utils.configure(args=args)
+    over_budget = []
+    for module in args.modules:
+        total_ms, report = import_report(module, top=args.top)
+        print(report)
+        if args.budget_ms is not None and total_ms > args.budget_ms:
+            over_budget.append(module)
+    if over_budget:
+        logger.error(f"over the {args.budget_ms} ms import budget: {over_budget}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="report module import times")
+    parser.add_argument("modules", nargs="+", help="modules to import, e.g. src.models")
+    parser.add_argument("--top", type=int, default=10, help="imports to list")
+    parser.add_argument("--budget-ms", type=float, default=None, help="max import ms")
+    logging_utils.add_logging_args(parser)
+    main(parser.parse_args())
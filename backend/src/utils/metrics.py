@@ -0,0 +1,217 @@
+"""Minimal metrics in the Prometheus text exposition format, without depending on
+`prometheus_client`. Metrics live in the process that records them, so with several
+workers every worker reports its own."""
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator, Optional, Sequence, Union
+
+LabelValues = tuple[str, ...]
+
+# seconds, 0.1 ms to 50 s: from sub-millisecond stages to long prompts on the CPU
+DEFAULT_BUCKETS = tuple(
+    base * 10.0**exponent for exponent in range(-4, 2) for base in (1, 2.5, 5)
+)
+# bytes, 1 KB to 16 GB
+BYTE_BUCKETS = tuple(float(4**i * 2**10) for i in range(13))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if len(names) == 0:
+        return ""
+    pairs = ",".join(
+        f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+class Metric:
+    type_name = "untyped"
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: Sequence[str] = ()
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _label_values(self, labels: dict[str, str]) -> LabelValues:
+        assert set(labels) == set(
+            self.labelnames
+        ), f"{self.name} needs labels {self.labelnames}, got {list(labels)}"
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> list[tuple[str, LabelValues, float]]:
+        """(suffix, label values, value) of every sample."""
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type_name}",
+        ]
+        for suffix, labels, value in self.samples():
+            names = self.labelnames
+            if suffix == "_bucket":  # the last label value is the bucket bound
+                names = (*names, "le")
+            lines.append(
+                f"{self.name}{suffix}{_format_labels(names, labels)} "
+                + _format_value(value)
+            )
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type_name = "counter"
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._values: dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        assert amount >= 0, "counters can only go up"
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def samples(self) -> list[tuple[str, LabelValues, float]]:
+        with self._lock:
+            return [("_total", key, value) for key, value in self._values.items()]
+
+
+class Gauge(Metric):
+    """A value that is set, or read from `function` on every scrape. The function
+    returns the value, or {label values: value} for gauges with labels."""
+
+    type_name = "gauge"
+
+    def __init__(
+        self,
+        *args,
+        function: Optional[Callable[[], Union[float, dict]]] = None,
+        **kwargs,
+    ) -> None:
+        super().__init__(*args, **kwargs)
+        self.function = function
+        self._values: dict[LabelValues, float] = {}
+
+    def set(self, value: float, **labels: str) -> None:
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def samples(self) -> list[tuple[str, LabelValues, float]]:
+        if self.function is not None:
+            values = self.function()
+            if not isinstance(values, dict):
+                values = {(): values}
+            return [
+                ("", tuple(str(v) for v in key), value) for key, value in values.items()
+            ]
+        with self._lock:
+            return [("", key, value) for key, value in self._values.items()]
+
+
+class Histogram(Metric):
+    type_name = "histogram"
+
+    def __init__(
+        self, *args, buckets: Sequence[float] = DEFAULT_BUCKETS, **kwargs
+    ) -> None:
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # per label values: count per bucket (not cumulative), sum
+        self._counts: dict[LabelValues, list[int]] = {}
+        self._sums: dict[LabelValues, float] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._label_values(labels)
+        bucket = next(i for i, bound in enumerate(self.buckets) if value <= bound)
+        with self._lock:
+            counts = self._counts.setdefault(key, [0] * len(self.buckets))
+            counts[bucket] += 1
+            self._sums[key] = self._sums.get(key, 0.0) + value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """Observes the seconds spent in the block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> list[tuple[str, LabelValues, float]]:
+        samples = []
+        with self._lock:
+            for key, counts in self._counts.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    bucket_key = (*key, _format_value(bound))
+                    samples.append(("_bucket", bucket_key, cumulative))
+                samples.append(("_sum", key, self._sums[key]))
+                samples.append(("_count", key, cumulative))
+        return samples
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self._metrics: dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        with self._lock:
+            assert metric.name not in self._metrics, f"{metric.name} is registered"
+            self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+PROMETHEUS_MIMETYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+METRICS = MetricsRegistry()
+
+# time spent per stage of serving attention: queue_wait, tokenization, forward,
+# device_to_host, detensorize, json_encode, binary_encode
+STAGE_SECONDS = METRICS.register(
+    Histogram(
+        "attention_stage_seconds",
+        "Time spent in each stage of serving attention",
+        labelnames=("stage",),
+    )
+)
+TOKENS_PROCESSED = METRICS.register(
+    Counter("attention_tokens_processed", "Prompt tokens run through the model")
+)
+# bytes of the arrays in each result, i.e. what is held on the host per request
+RESULT_BYTES = METRICS.register(
+    Histogram(
+        "attention_result_bytes",
+        "Bytes of the arrays in each attention result",
+        buckets=BYTE_BUCKETS,
+    )
+)
+DEVICE_PEAK_BYTES = METRICS.register(
+    Histogram(
+        "attention_device_peak_bytes",
+        "Peak CUDA memory allocated during each batched forward",
+        buckets=BYTE_BUCKETS,
+    )
+)
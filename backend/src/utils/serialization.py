@@ -0,0 +1,115 @@
+"""Compact binary encoding for results that carry large arrays.
+
+Layout of an encoded buffer:
+
+    [uint32 little-endian header length][JSON header][padding][array buffers]
+
+The JSON header holds the non-array fields under `metadata` and, for every array,
+its name, dtype, shape and byte offset (relative to the start of the array section)
+under `arrays`. Every buffer starts on an 8 byte boundary so that clients can view
+them directly as typed arrays without copying. Quantized (`uint8`) arrays also store
+the `min` and `scale` needed to recover `x = min + q * scale`.
+"""
+import json
+import struct
+from typing import Any, Literal
+
+import numpy as np
+import torch
+
+BINARY_MIMETYPE = "application/octet-stream"
+ALIGNMENT = 8
+
+BinaryDtype = Literal["float32", "float16", "uint8"]
+
+
+def _pad(n_bytes: int) -> int:
+    return (-n_bytes) % ALIGNMENT
+
+
+def _encode_array(array: np.ndarray, dtype: BinaryDtype) -> tuple[np.ndarray, dict]:
+    spec: dict[str, Any] = {"shape": list(array.shape)}
+    if not np.issubdtype(array.dtype, np.floating):
+        # indices, counts etc. are kept as they are
+        array = np.ascontiguousarray(array)
+    elif dtype == "uint8":
+        low = float(array.min()) if array.size > 0 else 0.0
+        high = float(array.max()) if array.size > 0 else 0.0
+        scale = (high - low) / 255 if high > low else 1.0
+        array = np.rint((array - low) / scale).astype(np.uint8)
+        spec.update(min=low, scale=scale)
+    else:
+        array = np.ascontiguousarray(array, dtype=dtype)
+    spec["dtype"] = array.dtype.str  # explicit byte order, e.g. "<f2"
+    return array, spec
+
+
+def encode_binary(
+    metadata: dict[str, Any],
+    arrays: dict[str, np.ndarray],
+    dtype: BinaryDtype = "float16",
+) -> bytes:
+    """Encode `metadata` and `arrays` into a single buffer.
+
+    Args:
+        metadata: JSON serializable fields.
+        arrays: Named arrays. Floating point arrays are cast to `dtype`.
+        dtype: Encoding for floating point arrays.
+
+    Returns:
+        The encoded buffer.
+    """
+    assert dtype in ("float32", "float16", "uint8"), f"unknown {dtype=}"
+    chunks, specs, offset = [], [], 0
+    for name, array in arrays.items():
+        encoded, spec = _encode_array(np.asarray(array), dtype)
+        spec.update(name=name, offset=offset, nbytes=encoded.nbytes)
+        chunks.append(encoded)
+        specs.append(spec)
+        offset += encoded.nbytes + _pad(encoded.nbytes)
+
+    header = json.dumps({"metadata": metadata, "arrays": specs}).encode("utf-8")
+    header += b" " * _pad(4 + len(header))
+
+    out = bytearray(struct.pack("<I", len(header)))
+    out += header
+    for encoded in chunks:
+        out += memoryview(encoded).cast("B")
+        out += b"\0" * _pad(encoded.nbytes)
+    return bytes(out)
+
+
+def decode_binary(
+    buffer: bytes, dequantize: bool = True
+) -> tuple[dict[str, Any], dict[str, np.ndarray]]:
+    """Inverse of `encode_binary`. Arrays are zero-copy views into `buffer` unless
+    they need to be dequantized."""
+    (header_length,) = struct.unpack_from("<I", buffer, 0)
+    header = json.loads(bytes(buffer[4 : 4 + header_length]).decode("utf-8"))
+    start = 4 + header_length
+    arrays = {}
+    for spec in header["arrays"]:
+        array = np.frombuffer(
+            buffer,
+            dtype=np.dtype(spec["dtype"]),
+            count=int(np.prod(spec["shape"])),
+            offset=start + spec["offset"],
+        ).reshape(spec["shape"])
+        if dequantize and "scale" in spec:
+            array = spec["min"] + array.astype(np.float32) * spec["scale"]
+        arrays[spec["name"]] = array
+    return header["metadata"], arrays
+
+
+def binarize_objects(obj: Any, dtype: BinaryDtype = "float16") -> bytes:
+    """Binary counterpart of `functional.detensorize_objects`: tensor/array fields
+    of `obj` go to the array section, everything else to the JSON header."""
+    metadata, arrays = {}, {}
+    for key, value in obj.__dict__.items():
+        if isinstance(value, torch.Tensor):
+            arrays[key] = value.detach().cpu().numpy()
+        elif isinstance(value, np.ndarray):
+            arrays[key] = value
+        else:
+            metadata[key] = value
+    return encode_binary(metadata=metadata, arrays=arrays, dtype=dtype)
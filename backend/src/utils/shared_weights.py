@@ -0,0 +1,156 @@
+"""Share one copy of the model weights between several worker processes.
+
+The weights are exported once into a single file in their final dtype. Every worker
+then builds the model skeleton without allocating any weights and points its
+parameters at a memory-map of that file. The pages live in the OS page cache and are
+shared read-only by all the workers, so N workers cost one copy of the weights
+instead of N. Only useful for models that stay on the CPU.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Any, Optional
+
+import torch
+from src.models import ModelandTokenizer
+from src.utils import logging_utils
+from src.utils.env_utils import PathLike
+from src.utils.timing import PhaseTimer
+
+logger = logging.getLogger(__name__)
+
+
+# config fields that depend on how the model was loaded, not on its weights
+_LOADING_FIELDS = (
+    "_name_or_path",
+    "_attn_implementation",
+    "_commit_hash",
+    "torch_dtype",
+    "transformers_version",
+)
+
+
+def config_fingerprint(config: Any) -> str:
+    """Hash of a model config, without the fields that only depend on loading."""
+    fields = {
+        key: value
+        for key, value in config.to_dict().items()
+        if key not in _LOADING_FIELDS
+    }
+    encoded = json.dumps(fields, sort_keys=True, default=str).encode()
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def export_shared_weights(
+    model: torch.nn.Module, path: PathLike, model_name: Optional[str] = None
+) -> Path:
+    """Saves every parameter and buffer of `model` (including tied and
+    non-persistent ones, which `state_dict` would skip) to `path`, with the model
+    name (default: the config's `_name_or_path`) and a fingerprint of its config
+    to check against when loading."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tensors = {
+        **dict(model.named_parameters(remove_duplicate=False)),
+        **dict(model.named_buffers(remove_duplicate=False)),
+    }
+    tensors = {name: tensor.detach().cpu() for name, tensor in tensors.items()}
+    exported = {
+        "model": model_name or model.config._name_or_path,
+        "config": config_fingerprint(model.config),
+        "tensors": tensors,
+    }
+    # write to a temporary file first so workers never see a partial file
+    tmp_path = path.with_name(path.name + ".tmp")
+    torch.save(exported, tmp_path)
+    os.replace(tmp_path, path)
+    logger.info(f"exported {len(tensors)} tensors of <{exported['model']}> to {path}")
+    return path
+
+
+def _assign(model: torch.nn.Module, name: str, tensor: torch.Tensor) -> None:
+    module_name, _, leaf = name.rpartition(".")
+    try:
+        module = model.get_submodule(module_name)
+    except AttributeError:
+        raise ValueError(f"{name} is not in the model")
+    if leaf in module._parameters:
+        expected = module._parameters[leaf]
+    elif leaf in module._buffers:
+        expected = module._buffers[leaf]
+    else:
+        raise ValueError(f"{name} is not in the model")
+    if expected is not None and expected.shape != tensor.shape:
+        raise ValueError(
+            f"{name} has shape {tuple(tensor.shape)}, the model expects "
+            f"{tuple(expected.shape)}"
+        )
+    if leaf in module._parameters:
+        module._parameters[leaf] = torch.nn.Parameter(tensor, requires_grad=False)
+    else:
+        module._buffers[leaf] = tensor
+
+
+def load_shared_model(model_path: str, weights_path: PathLike) -> ModelandTokenizer:
+    """
+    Loads `model_path` with its weights memory-mapped from `weights_path` (see
+    `export_shared_weights`). Nothing is copied, so the weights stay in the dtype
+    they were exported in. Raises `ValueError` if the file was exported from
+    another model, or its tensors do not fit the model.
+    """
+    from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer
+
+    timings = PhaseTimer()
+    with timings.phase("tokenizer"):
+        tokenizer = AutoTokenizer.from_pretrained(model_path)
+    tokenizer.pad_token = tokenizer.eos_token
+
+    with timings.phase("weights"):
+        config = AutoConfig.from_pretrained(model_path)
+        exported = torch.load(
+            weights_path, mmap=True, map_location="cpu", weights_only=True
+        )
+        if "tensors" not in exported:
+            raise ValueError(f"{weights_path} has no model metadata, export it again")
+        if exported["model"] != model_path:
+            raise ValueError(
+                f"{weights_path} holds the weights of <{exported['model']}>, not "
+                f"<{model_path}>. delete it to export them again"
+            )
+        if exported["config"] != config_fingerprint(config):
+            raise ValueError(
+                f"{weights_path} was exported from another config of <{model_path}>"
+                ". delete it to export the weights again"
+            )
+        with torch.device("meta"):
+            model = AutoModelForCausalLM.from_config(config)
+        for name, tensor in exported["tensors"].items():
+            _assign(model, name, tensor)
+    on_meta = [name for name, p in model.named_parameters() if p.is_meta]
+    assert len(on_meta) == 0, f"{on_meta} were not in {weights_path}"
+    model.eval()
+
+    logger.info(f"loaded model <{model_path}> with weights mapped from {weights_path}")
+    mt = ModelandTokenizer(model=model, tokenizer=tokenizer)
+    mt.timings = timings
+    return mt
+
+
+def main(args: argparse.Namespace) -> None:
+    logging_utils.configure(args=args)
+    mt = ModelandTokenizer(
+        model_path=args.model, torch_dtype=getattr(torch, args.torch_dtype)
+    )
+    export_shared_weights(mt.model, args.out, model_name=args.model)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="export weights for shared loading")
+    parser.add_argument("--model", required=True, help="model name or path")
+    parser.add_argument("--out", required=True, type=Path, help="weights file")
+    parser.add_argument("--torch-dtype", default="float32", help="e.g. float16")
+    logging_utils.add_logging_args(parser)
+    main(parser.parse_args())
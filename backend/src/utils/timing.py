@@ -0,0 +1,30 @@
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+
+class PhaseTimer:
+    """Wall-clock time of named phases, e.g. the steps of loading a model.
+    Time spent in a phase that is entered more than once is added up."""
+
+    def __init__(self) -> None:
+        self.phases: dict[str, float] = {}
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+    @property
+    def total(self) -> float:
+        return sum(self.phases.values())
+
+    def report(self) -> str:
+        return " | ".join(
+            [f"{name}: {elapsed:.3f}s" for name, elapsed in self.phases.items()]
+            + [f"total: {self.total:.3f}s"]
+        )
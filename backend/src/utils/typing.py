@@ -1,29 +1,16 @@
 """Some useful type aliases relevant to this project."""
 
 import pathlib
-from typing import Literal, Sequence
+from typing import Any, Literal, Sequence
 
 import numpy
 import torch
-import transformers
-import transformers.modeling_outputs
 
 ArrayLike = list | tuple | numpy.ndarray | torch.Tensor
 PathLike = str | pathlib.Path
 Device = str | torch.device
 
-# Throughout this codebase, we use HuggingFace model implementations.
-Model = (
-    transformers.GPT2LMHeadModel
-    | transformers.GPTJForCausalLM
-    | transformers.GPTNeoXForCausalLM
-    | transformers.LlamaForCausalLM
-)
-Tokenizer = transformers.PreTrainedTokenizerFast
 TokenizerOffsetMapping = Sequence[tuple[int, int]]
-ModelInput = transformers.BatchEncoding
-ModelOutput = transformers.modeling_outputs.CausalLMOutput
-ModelGenerateOutput = transformers.generation.utils.GenerateOutput | torch.LongTensor
 
 Layer = int | Literal["emb"] | Literal["ln_f"]
 
@@ -32,3 +19,42 @@ Layer = int | Literal["emb"] | Literal["ln_f"]
 StrSequence = list[str] | tuple[str, ...]
 
 Tensor = torch.Tensor | numpy.ndarray
+
+
+def _transformers_aliases() -> dict[str, Any]:
+    import transformers
+    import transformers.modeling_outputs
+
+    return {
+        # Throughout this codebase, we use HuggingFace model implementations.
+        "Model": (
+            transformers.GPT2LMHeadModel
+            | transformers.GPTJForCausalLM
+            | transformers.GPTNeoXForCausalLM
+            | transformers.LlamaForCausalLM
+        ),
+        "Tokenizer": transformers.PreTrainedTokenizerFast,
+        "ModelInput": transformers.BatchEncoding,
+        "ModelOutput": transformers.modeling_outputs.CausalLMOutput,
+        "ModelGenerateOutput": (
+            transformers.generation.utils.GenerateOutput | torch.LongTensor
+        ),
+    }
+
+
+_TRANSFORMERS_ALIASES = (
+    "Model",
+    "Tokenizer",
+    "ModelInput",
+    "ModelOutput",
+    "ModelGenerateOutput",
+)
+
+
+def __getattr__(name: str) -> Any:
+    """The aliases of transformers classes import (most of) transformers, so they
+    are only built the first time one of them is used."""
+    if name in _TRANSFORMERS_ALIASES:
+        globals().update(_transformers_aliases())
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,18 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+# the backend is imported as `src...` and `benchmarks...`, as when running app.py
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+
+@pytest.fixture(scope="session", params=["gpt2", "llama", "gpt_neox"])
+def mt(request):
+    """A tiny random model with an offline word-level tokenizer (words `w0`, `w1`,
+    ...), see `benchmarks.tiny_models`."""
+    pytest.importorskip("torch")
+    pytest.importorskip("transformers")
+    from benchmarks.tiny_models import make_tiny_model
+
+    return make_tiny_model(request.param, n_layer=2, d_model=32)
@@ -0,0 +1,85 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+torch = pytest.importorskip("torch")
+
+from src.attention import (  # noqa: E402
+    PromptState,
+    get_attention_matrices,
+    get_attention_matrices_incremental,
+    get_attention_rows,
+    truncate_past_key_values,
+)
+
+PROMPT = "w1 w2 w3 w4 w5 w6"
+EDITED = "w1 w2 w3 w4 w9 w8 w7"
+
+
+@pytest.mark.parametrize("value_weighted", [False, True])
+def test_incremental_matches_full_recompute(mt, value_weighted):
+    _, state = get_attention_matrices_incremental(
+        PROMPT, mt, value_weighted=value_weighted
+    )
+    incremental, _ = get_attention_matrices_incremental(
+        EDITED, mt, previous=state, value_weighted=value_weighted
+    )
+    full = get_attention_matrices(EDITED, mt, value_weighted=value_weighted)
+
+    assert incremental.tokenized_prompt == full.tokenized_prompt
+    np.testing.assert_allclose(
+        incremental.attention_matrices, full.attention_matrices, atol=1e-5
+    )
+
+
+def test_incremental_rebuilds_missing_kv_cache(mt):
+    """Sessions keep only the attention rows of prompts served by the scheduler."""
+    previous = get_attention_matrices(PROMPT, mt)
+    state = PromptState(
+        input_ids=mt.tokenizer(PROMPT).input_ids,
+        past_key_values=None,
+        attention_information=previous,
+        value_weighted=False,
+    )
+    incremental, next_state = get_attention_matrices_incremental(
+        EDITED, mt, previous=state
+    )
+    full = get_attention_matrices(EDITED, mt)
+
+    np.testing.assert_allclose(
+        incremental.attention_matrices, full.attention_matrices, atol=1e-5
+    )
+    assert next_state.past_key_values is not None
+
+
+@pytest.mark.parametrize("value_weighted", [False, True])
+@pytest.mark.parametrize("rows", [(0, 3), (2, 6)])
+def test_rows_match_full_matrices(mt, rows, value_weighted):
+    # tiles of 2 rows, so the kv cache of the prefix and of earlier tiles is reused
+    tiled = get_attention_rows(
+        EDITED, mt, rows=rows, value_weighted=value_weighted, tile_size=2
+    )
+    full = get_attention_matrices(EDITED, mt, value_weighted=value_weighted)
+
+    assert tiled.rows == list(rows)
+    assert tiled.tokenized_prompt == full.tokenized_prompt
+    np.testing.assert_allclose(
+        tiled.attention_matrices,
+        full.attention_matrices[:, :, rows[0] : rows[1]],
+        atol=1e-5,
+    )
+
+
+def test_truncate_past_key_values_keeps_the_cache_format(mt):
+    input_ids = torch.tensor([mt.tokenizer(PROMPT).input_ids], device=mt.device)
+    with torch.inference_mode():
+        past_key_values = mt.model(input_ids, use_cache=True).past_key_values
+    n_tokens = input_ids.shape[-1]
+
+    truncated = truncate_past_key_values(past_key_values, 2)
+
+    assert isinstance(truncated, tuple) == isinstance(past_key_values, tuple)
+    for layer in range(mt.n_layer):
+        assert truncated[layer][0].shape[-2] == 2
+        assert truncated[layer][1].shape[-2] == 2
+        # the input is left as it was
+        assert past_key_values[layer][0].shape[-2] == n_tokens
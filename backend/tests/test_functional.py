@@ -0,0 +1,84 @@
+import random
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("torch")
+
+from benchmarks.tiny_models import make_prompt  # noqa: E402
+from src.functional import (  # noqa: E402
+    get_h,
+    get_h_batched,
+    make_length_batches,
+    predict_next_token,
+)
+
+
+@pytest.fixture
+def prompts():
+    """Prompts of mixed lengths, not sorted by length."""
+    rng = random.Random(0)
+    return [make_prompt(length, rng) for length in (5, 17, 3, 17, 9, 12, 1, 6)]
+
+
+def test_make_length_batches():
+    lengths = [5, 17, 3, 17, 9, 12, 1, 6]
+    batches = make_length_batches(lengths, max_batch_size=3, max_batch_tokens=36)
+
+    assert sorted(idx for batch in batches for idx in batch) == list(range(8))
+    for batch in batches:
+        assert len(batch) <= 3
+        # padded to the longest prompt, which comes first
+        assert lengths[batch[0]] == max(lengths[idx] for idx in batch)
+        assert len(batch) == 1 or len(batch) * lengths[batch[0]] <= 36
+
+
+@pytest.mark.parametrize("max_batch_tokens", [None, 24])
+def test_predict_next_token_batched_matches_one_by_one(mt, prompts, max_batch_tokens):
+    # ids, the word-level tokenizer adds no BOS token for `get_token_ids` to skip
+    interest = list(range(2, 2 + len(prompts)))
+    batched, batched_interest = predict_next_token(
+        mt,
+        prompts,
+        k=5,
+        batch_size=4,
+        max_batch_tokens=max_batch_tokens,
+        token_of_interest=interest,
+        return_arrays=True,
+    )
+    for idx, (prompt, token) in enumerate(zip(prompts, interest)):
+        single, single_interest = predict_next_token(
+            mt, prompt, k=5, token_of_interest=token, return_arrays=True
+        )
+        np.testing.assert_allclose(batched.probs[idx], single.probs[0], atol=1e-5)
+        np.testing.assert_array_equal(batched.token_ids[idx], single.token_ids[0])
+        assert batched_interest.token_ids[idx] == single_interest.token_ids[0]
+        assert batched_interest.ranks[idx] == single_interest.ranks[0]
+        np.testing.assert_allclose(
+            batched_interest.probs[idx], single_interest.probs[0], atol=1e-5
+        )
+
+
+@pytest.mark.parametrize("mode", ["output", "input"])
+@pytest.mark.parametrize("max_batch_tokens", [None, 24])
+def test_get_h_batched_matches_get_h(mt, prompts, mode, max_batch_tokens):
+    # the second to last word of every prompt, the only word of one-word prompts
+    subjects = [" ".join(prompt.split()[-2:][:1]) for prompt in prompts]
+    layers = mt.layer_names
+    batched = get_h_batched(
+        mt,
+        prompts,
+        subjects,
+        layers,
+        mode=mode,
+        batch_size=4,
+        max_batch_tokens=max_batch_tokens,
+    )
+
+    assert batched.shape == (len(prompts), len(layers), mt.n_embd)
+    for idx, (prompt, subject) in enumerate(zip(prompts, subjects)):
+        h = get_h(mt, prompt, subject, layers, mode=mode)
+        for layer_idx, layer in enumerate(layers):
+            np.testing.assert_allclose(
+                batched[idx, layer_idx].numpy(), h[layer].cpu().numpy(), atol=1e-5
+            )
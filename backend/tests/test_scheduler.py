@@ -0,0 +1,78 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("torch")
+
+import src.scheduler  # noqa: E402
+from src.attention import get_attention_matrices  # noqa: E402
+from src.scheduler import AttentionScheduler  # noqa: E402
+
+PROMPTS = ["w1 w2 w3", "w4 w5 w6 w7 w8", "w9", "w2 w4 w6 w8"]
+
+
+@pytest.fixture
+def scheduler(mt):
+    # a long wait, so that prompts submitted together share a forward
+    scheduler = AttentionScheduler(mt, max_batch_size=8, max_wait_ms=200)
+    yield scheduler
+    scheduler.close(timeout=10)
+
+
+@pytest.fixture
+def batch_sizes(scheduler, monkeypatch):
+    sizes = []
+    forward = scheduler._forward
+
+    def record(requests):
+        sizes.append(len(requests))
+        return forward(requests)
+
+    monkeypatch.setattr(scheduler, "_forward", record)
+    return sizes
+
+
+def test_batched_results_match_one_by_one(mt, scheduler, batch_sizes):
+    futures = [scheduler.submit(prompt) for prompt in PROMPTS]
+    results = [future.result(timeout=30) for future in futures]
+
+    assert batch_sizes == [len(PROMPTS)]
+    for prompt, result in zip(PROMPTS, results):
+        single = get_attention_matrices(prompt, mt)
+        assert result.tokenized_prompt == single.tokenized_prompt
+        np.testing.assert_allclose(
+            result.attention_matrices, single.attention_matrices, atol=1e-5
+        )
+
+
+def test_bad_prompt_fails_alone(mt, scheduler, batch_sizes, monkeypatch):
+    def fail_on_bad(prompt, **kwargs):
+        if "bad" in prompt:
+            raise RuntimeError("bad prompt")
+        return get_attention_matrices(prompt, **kwargs)
+
+    monkeypatch.setattr(src.scheduler, "get_attention_matrices", fail_on_bad)
+    prompts = [*PROMPTS[:2], "bad", *PROMPTS[2:]]
+    futures = [scheduler.submit(prompt) for prompt in prompts]
+    with pytest.raises(RuntimeError, match="bad prompt"):
+        futures[2].result(timeout=30)
+    results = [future.result(timeout=30) for i, future in enumerate(futures) if i != 2]
+
+    # the batch fails, then every prompt is retried on its own
+    assert batch_sizes == [len(prompts)] + [1] * len(prompts)
+    for prompt, result in zip(PROMPTS, results):
+        single = get_attention_matrices(prompt, mt)
+        np.testing.assert_allclose(
+            result.attention_matrices, single.attention_matrices, atol=1e-5
+        )
+
+
+def test_worker_survives_failures_after_the_forward(scheduler, monkeypatch):
+    def fail(result):
+        raise RuntimeError("result handling failed")
+
+    monkeypatch.setattr(src.scheduler, "result_nbytes", fail)
+    with pytest.raises(RuntimeError, match="result handling failed"):
+        scheduler.submit(PROMPTS[0]).result(timeout=30)
+
+    monkeypatch.undo()
+    assert scheduler.submit(PROMPTS[1]).result(timeout=30) is not None
@@ -0,0 +1,20 @@
+import pytest
+
+from src import serving
+from src.serving import split_cores
+
+
+def test_split_cores_evenly(monkeypatch):
+    monkeypatch.setattr(serving, "available_cores", lambda: list(range(10)))
+
+    assert split_cores(3) == [[0, 1, 2, 3], [4, 5, 6], [7, 8, 9]]
+    with pytest.raises(ValueError):
+        split_cores(11)
+
+
+def test_split_cores_configured():
+    assert split_cores(2, [[0, 2], [1, 3]]) == [[0, 2], [1, 3]]
+    with pytest.raises(ValueError):
+        split_cores(2, [[0, 1]])
+    with pytest.raises(ValueError):
+        split_cores(2, [[0, 1], []])